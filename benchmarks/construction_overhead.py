@@ -0,0 +1,32 @@
+"""
+Show how much counting errors with ErrorMetrics adds to creating a DelfickError
+
+    python benchmarks/construction_overhead.py [count]
+"""
+from delfick_error import DelfickError
+from delfick_error_metrics import ErrorMetrics
+
+import timeit
+import sys
+
+class AnError(DelfickError):
+    desc = "an error"
+
+def create():
+    AnError("blah", stage="one", thing=1)
+
+def per_call(count):
+    return min(timeit.repeat(create, number=count, repeat=5)) / count * 1e9
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    without = per_call(count)
+    with ErrorMetrics():
+        by_class = per_call(count)
+    with ErrorMetrics(labels=["stage"]):
+        with_labels = per_call(count)
+
+    print("Without metrics: {0:.0f}ns per error".format(without))
+    print("Counting by class: {0:.0f}ns per error".format(by_class))
+    print("Counting by class and stage: {0:.0f}ns per error".format(with_labels))
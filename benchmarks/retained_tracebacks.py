@@ -0,0 +1,47 @@
+"""
+Show how much memory is kept alive by the tracebacks of collected errors
+
+    python benchmarks/retained_tracebacks.py [count]
+"""
+from delfick_error import DelfickError, ErrorCollector
+
+import tracemalloc
+import sys
+import gc
+
+def fail(depth, i):
+    # Some locals that would be kept alive by the traceback
+    payload = [i] * 100
+    if depth == 0:
+        raise ValueError("Failed {0}".format(i))
+    return fail(depth - 1, i) + len(payload)
+
+def collect(count, detach_tracebacks):
+    collector = ErrorCollector(DelfickError, "Failed", detach_tracebacks=detach_tracebacks)
+    for i in range(count):
+        try:
+            fail(10, i)
+        except ValueError as error:
+            collector.add(error)
+    return collector.error()
+
+def retained(count, detach_tracebacks):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        error = collect(count, detach_tracebacks)
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert len(error.errors) == count
+    return current
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    with_tb = retained(count, False)
+    without_tb = retained(count, True)
+    print("Errors collected: {0}".format(count))
+    print("Retained with tracebacks: {0:,} bytes".format(with_tb))
+    print("Retained with detached tracebacks: {0:,} bytes".format(without_tb))
+    print("Ratio: {0:.1f}x".format(with_tb / float(without_tb)))
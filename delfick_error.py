@@ -2,13 +2,51 @@
 from __future__ import print_function
 
 from total_ordering import total_ordering
+from collections import OrderedDict
 from contextlib import contextmanager
 import traceback
+import linecache
 import unittest
 import sys
+import itertools
+import functools
+import threading
+import hashlib
+import logging
 import six
 import re
 
+try:
+    from collections import ChainMap
+except ImportError:
+    # Python2 doesn't have ChainMap, so with_kwargs makes a copy instead
+    ChainMap = None
+
+try:
+    import contextvars
+except ImportError:
+    # Ambient kwargs need contextvars, which is only in python3.7+
+    contextvars = None
+
+try:
+    ExceptionGroup = ExceptionGroup
+    BaseExceptionGroup = BaseExceptionGroup
+except NameError:
+    # ExceptionGroup is only in python3.11+
+    ExceptionGroup = None
+    BaseExceptionGroup = None
+
+try:
+    from types import MappingProxyType
+except ImportError:
+    # Python2 has no read only dictionary, so frozen errors just get a copy
+    MappingProxyType = dict
+
+try:
+    from collections.abc import Sequence
+except ImportError:
+    from collections import Sequence
+
 if hasattr(unittest, "util"):
     safe_repr = unittest.util.safe_repr
 else:
@@ -22,25 +60,517 @@ else:
             return result
         return result[:_MAX_LENGTH] + ' [truncated]...'
 
+class Lazy(object):
+    """
+    Wrap a callable so it's only evaluated when an error is rendered or compared
+
+    The callable is called at most once and the result, or the exception it
+    raised, is remembered.
+
+    .. code-block:: python
+
+        raise DelfickError("Bad request", body=Lazy(lambda: json.dumps(body)))
+    """
+    _unresolved = object()
+
+    def __init__(self, func):
+        self.func = func
+        self.error = None
+        self.value = self._unresolved
+        self.lock = threading.Lock()
+
+    @property
+    def resolved(self):
+        return self.value is not self._unresolved or self.error is not None
+
+    def resolve(self):
+        """Call our func if we haven't already and return the result, or raise the error it raised"""
+        if self.value is self._unresolved and self.error is None:
+            # Errors are often rendered from many threads, so only one may call func
+            with self.lock:
+                if self.value is self._unresolved and self.error is None:
+                    try:
+                        self.value = self.func()
+                    except Exception as error:
+                        self.error = error
+                    self.func = None
+
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        if self.error is not None:
+            return "<Lazy failed {0!r}>".format(self.error)
+        if self.resolved:
+            return "<Lazy {0!r}>".format(self.value)
+        return "<Lazy unresolved>"
+
+def resolved(val):
+    """Return the value behind val if it's a Lazy, otherwise just val"""
+    if isinstance(val, Lazy):
+        return val.resolve()
+    return val
+
+class ErrorsChain(Sequence):
+    """
+    A read only sequence of errors made up of other sequences of errors
+
+    Used by ``DelfickError.with_errors`` so that adding errors doesn't need to
+    copy the errors we already have.
+    """
+    def __init__(self, *parts):
+        self.parts = []
+        for part in parts:
+            if isinstance(part, ErrorsChain):
+                self.parts.extend(part.parts)
+            elif part:
+                self.parts.append(part)
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.parts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+
+        if index < 0:
+            index += len(self)
+
+        if index >= 0:
+            for part in self.parts:
+                if index < len(part):
+                    return part[index]
+                index -= len(part)
+
+        raise IndexError("ErrorsChain index out of range")
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, tuple, ErrorsChain)):
+            return NotImplemented
+        return len(self) == len(other) and list(self) == list(other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
+
+if contextvars is not None:
+    _ambient_kwargs = contextvars.ContextVar("delfick_error_ambient_kwargs", default=None)
+else:
+    _ambient_kwargs = None
+
+@contextmanager
+def ambient_kwargs(**kwargs):
+    """
+    Add kwargs to the output of any DelfickError created in this context
+
+    The ambient kwargs are captured by reference when the error is created and
+    only merged with the error's own kwargs when it is rendered. Kwargs given to
+    the error itself take precedence.
+
+    This uses contextvars, so each asyncio task sees the ambient kwargs from
+    where it was created, and new threads start without any ambient kwargs.
+    """
+    if _ambient_kwargs is None:
+        raise ProgrammerError("Ambient kwargs require contextvars, which is only in python3.7+")
+
+    current = _ambient_kwargs.get()
+    if current:
+        kwargs = dict(current, **kwargs)
+
+    token = _ambient_kwargs.set(kwargs)
+    try:
+        yield
+    finally:
+        _ambient_kwargs.reset(token)
+
+def detach_traceback(error):
+    """
+    Remove the traceback from an error, from any errors it was raised from and
+    from the errors it holds if it's a DelfickError or an ExceptionGroup, so that
+    we don't keep alive every frame and local variable of the failing call.
+
+    The traceback is replaced with ``error.traceback_summary``, a tuple of
+    (filename, lineno, function name) for each frame.
+    """
+    seen = set()
+    todo = [error]
+    while todo:
+        error = todo.pop()
+        if error is None or id(error) in seen:
+            continue
+        seen.add(id(error))
+
+        tb = getattr(error, "__traceback__", None)
+        if tb is not None:
+            summary = []
+            while tb is not None:
+                code = tb.tb_frame.f_code
+                summary.append((code.co_filename, tb.tb_lineno, code.co_name))
+                tb = tb.tb_next
+
+            error.traceback_summary = tuple(summary)
+            error.__traceback__ = None
+
+        todo.append(getattr(error, "__cause__", None))
+        todo.append(getattr(error, "__context__", None))
+
+        if isinstance(error, DelfickError):
+            todo.extend(error.errors)
+        elif BaseExceptionGroup is not None and isinstance(error, BaseExceptionGroup):
+            todo.extend(error.exceptions)
+
+log = logging.getLogger("delfick_error")
+
+_construction_hooks = ()
+
+def add_construction_hook(hook):
+    """
+    Call hook with every DelfickError after it's been created
+
+    When there are no hooks, creating an error only costs a check of an empty tuple.
+    Exceptions from the hook are logged to the ``delfick_error`` logger rather
+    than replacing the error that was being created.
+    """
+    global _construction_hooks
+    _construction_hooks = _construction_hooks + (hook, )
+
+def remove_construction_hook(hook):
+    """Stop calling a hook added by add_construction_hook"""
+    global _construction_hooks
+    _construction_hooks = tuple(h for h in _construction_hooks if h != hook)
+
+class HookRunner(object):
+    """
+    Run functions in daemon worker threads so we can stop waiting for them.
+
+    Used to give delfick_error_format hooks a time budget. A hook that takes
+    too long keeps running in it's worker, but we don't wait for it. That
+    worker stops counting towards max_workers until the hook finishes, so slow
+    hooks can't leave fast ones queued behind them.
+
+    There are never more than max_threads threads, including ones that are
+    stuck. If every thread is stuck then run gives up straight away.
+    """
+    def __init__(self, max_workers=4, max_threads=16):
+        self.max_workers = max_workers
+        self.max_threads = max_threads
+
+        self.idle = 0
+        self.workers = 0
+        self.threads = 0
+        self.lock = threading.Lock()
+        self.queue = six.moves.queue.Queue()
+
+    def run(self, timeout, func, *args):
+        """Return (True, result) or (False, None) if func didn't finish in time. Exceptions are raised."""
+        done = threading.Event()
+        # func, args, done, result, error, state
+        job = [func, args, done, None, None, "queued"]
+
+        with self.lock:
+            self.add_worker()
+            if self.workers == 0:
+                # Every thread is stuck and we can't make more
+                return False, None
+        self.queue.put(job)
+
+        if not done.wait(timeout):
+            with self.lock:
+                if job[5] == "running":
+                    # The worker is stuck with this job, so make room for another
+                    self.workers -= 1
+                    self.add_worker()
+                if job[5] != "done":
+                    job[5] = "abandoned"
+                    return False, None
+
+        done.wait()
+        if job[4] is not None:
+            raise job[4]
+        return True, job[3]
+
+    def add_worker(self):
+        """Start a worker if none are idle and we have room. Must hold the lock"""
+        if self.idle == 0 and self.workers < self.max_workers and self.threads < self.max_threads:
+            self.workers += 1
+            self.threads += 1
+            thread = threading.Thread(target=self.work, name="delfick_error_format_hooks")
+            thread.daemon = True
+            thread.start()
+
+    def work(self):
+        while True:
+            with self.lock:
+                self.idle += 1
+            job = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                if job[5] == "abandoned":
+                    continue
+                job[5] = "running"
+
+            func, args, done = job[:3]
+            try:
+                job[3] = func(*args)
+            except Exception as error:
+                job[4] = error
+            finally:
+                with self.lock:
+                    # If we were stuck then we were replaced and may not be needed anymore
+                    rejoin = job[5] != "abandoned" or self.workers < self.max_workers
+                    if job[5] == "abandoned" and rejoin:
+                        self.workers += 1
+                    if not rejoin:
+                        self.threads -= 1
+                    job[5] = "done"
+                done.set()
+
+            if not rejoin:
+                return
+
+hook_runner = HookRunner()
+
+_render_state = threading.local()
+
+def render_scope(func):
+    """
+    Decorator for methods that render an error.
+
+    Formatting hooks that run out of their time budget are remembered until the
+    outermost render is finished so they aren't waited on again.
+    """
+    @functools.wraps(func)
+    def wrapped(*args, **kwargs):
+        if getattr(_render_state, "slow", None) is not None:
+            return func(*args, **kwargs)
+
+        _render_state.slow = set()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _render_state.slow = None
+    return wrapped
+
+def render_placeholder(text):
+    """
+    Return text to show instead of a value that couldn't be formatted, and
+    remember that the current render used a placeholder so it isn't cached.
+    """
+    _render_state.placeholders = True
+    return text
+
+def render_oneline(error):
+    if hasattr(error, "oneline"):
+        return error.oneline()
+    return str(error)
+
+def render_dict(error):
+    if hasattr(error, "as_dict"):
+        return error.as_dict()
+    return repr(error)
+
+render_modes = {"oneline": render_oneline, "full": str, "dict": render_dict}
+
+def render_many(errors, mode="oneline"):
+    """
+    Yield the rendered form of each error
+
+    mode is "oneline" for ``error.oneline()``, "full" for ``str(error)`` or "dict"
+    for ``error.as_dict()``.
+
+    This is the same as rendering each error on it's own, except the output of
+    ``delfick_error_format`` hooks is shared between all the errors, and slow
+    hooks that run out of their ``format_budget`` are skipped for the rest of
+    the batch.
+    """
+    # Not a generator itself so that a bad mode is complained about straight away
+    if mode not in render_modes:
+        raise ProgrammerError("Unknown render mode {0}, choose from {1}".format(mode, sorted(render_modes)))
+    return _render_many(errors, render_modes[mode])
+
+def _render_many(errors, render):
+    slow = set()
+    formatted = {}
+    for error in errors:
+        outer = (getattr(_render_state, "slow", None), getattr(_render_state, "formatted", None))
+        _render_state.slow, _render_state.formatted = slow, formatted
+        try:
+            result = render(error)
+        finally:
+            _render_state.slow, _render_state.formatted = outer
+        yield result
+
+_compiled_regexes = OrderedDict()
+
+def compiled_regex(regex, max_size=256):
+    """
+    Return a compiled version of this regex, remembering the max_size most
+    recently used ones.
+
+    If regex is already compiled then it is returned as is.
+    """
+    if not isinstance(regex, (six.string_types, bytes)):
+        return regex
+
+    # Take it out and put it back so it becomes the most recently used
+    compiled = _compiled_regexes.pop(regex, None)
+    if compiled is None:
+        while len(_compiled_regexes) >= max_size:
+            try:
+                _compiled_regexes.popitem(last=False)
+            except KeyError:
+                break
+        compiled = re.compile(regex)
+    _compiled_regexes[regex] = compiled
+    return compiled
+
+_stack_locations = {}
+
+def capture_stack(depth, skip=None):
+    """
+    Return up to depth (code, lineno) pairs for the frames that called us.
+
+    If skip is provided, then frames at the top of the stack that are __init__
+    methods on that object are not included.
+    """
+    frame = sys._getframe(1)
+    while skip is not None and frame is not None and frame.f_code.co_name == "__init__" and frame.f_locals.get("self") is skip:
+        frame = frame.f_back
+
+    stack = []
+    while frame is not None and len(stack) < depth:
+        stack.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return tuple(stack)
+
+def stack_location(code, lineno):
+    """Return a string saying where this code and lineno is, remembering the answer"""
+    key = (code, lineno)
+    if key not in _stack_locations:
+        if len(_stack_locations) > 10000:
+            _stack_locations.clear()
+
+        location = "{0}:{1} in {2}".format(code.co_filename, lineno, code.co_name)
+        line = linecache.getline(code.co_filename, lineno).strip()
+        if line:
+            location = "{0}: {1}".format(location, line)
+        _stack_locations[key] = location
+    return _stack_locations[key]
+
+def hashable_val(val):
+    """Return val if it can be hashed, otherwise it's string form"""
+    val = resolved(val)
+    try:
+        hash(val)
+    except TypeError:
+        return str(val)
+    return val
+
 @total_ordering
 class DelfickError(Exception):
     """Helpful class for creating custom exceptions"""
     desc = ""
+    ambient_kwargs = None
+
+    # Set to True to remove the tracebacks of errors given as _errors
+    detach_tracebacks = False
+
+    # Set to a number of seconds to stop waiting for delfick_error_format hooks
+    format_budget = None
+
+    # Set to remember this many frames of where the error was created
+    stack_depth = 0
+    stack = None
+
+    def __init__(self, message="", *message_args, **kwargs):
+        if self.stack_depth:
+            self.stack = capture_stack(self.stack_depth, skip=self)
 
-    def __init__(self, message="", **kwargs):
         self.kwargs = kwargs
+        if _ambient_kwargs is not None:
+            self.ambient_kwargs = _ambient_kwargs.get()
         self.errors = kwargs.get("_errors", [])
         if "_errors" in kwargs:
             del kwargs["_errors"]
-        self.message = message
-        super(DelfickError, self).__init__(message)
+            if self.detach_tracebacks:
+                for error in self.errors:
+                    detach_traceback(error)
+
+        if message_args:
+            # Like logging, the message is only formatted when something looks at it
+            self._message = NotSpecified
+            self.message_template = message
+            self.message_args = message_args
+        else:
+            self.message = message
+
+        super(DelfickError, self).__init__(message, *message_args)
+
+        if _construction_hooks:
+            for hook in _construction_hooks:
+                try:
+                    hook(self)
+                except Exception:
+                    log.exception("Construction hook failed: hook=%r", hook)
+
+    @property
+    def message(self):
+        """The message, formatted from message_template and message_args on first access"""
+        if self._message is NotSpecified:
+            self._message = self.format_message(self.message_template, self.message_args)
+        return self._message
+
+    @message.setter
+    def message(self, message):
+        self._message = message
+        self.message_template = message
+        self.message_args = ()
+
+    def format_message(self, template, args):
+        """Format a message template with it's args using % formatting like logging does"""
+        args = tuple(resolved(arg) for arg in args)
+        if len(args) == 1 and isinstance(args[0], dict) and args[0]:
+            args = args[0]
+
+        try:
+            return template % args
+        except Exception as error:
+            return "<|Failed to format message for exception: template={0}, args={1}, error={2}|>".format(template, args, error)
 
+    def message_key(self):
+        """Identify the message without formatting it"""
+        return (self.message_template, self.message_args)
+
+    @render_scope
     def __str__(self):
         message = self.oneline()
+        if self.stack:
+            message = "{0}{1}".format(message, "".join("\n\tat {0}".format(location) for location in self.stack_summary()))
         if self.errors:
             message = "{0}\nerrors:\n=======\n\n\t{1}".format(message, "\n\t".join("{0}\n-------".format('\n\t'.join(str(error).split('\n'))) for error in self.errors))
         return message
 
+    @render_scope
     def as_dict(self):
         desc = self.desc
         message = self.message
@@ -57,12 +587,180 @@ class DelfickError(Exception):
         res = {}
         if desc is not None:
             res["message"] = desc
-        res.update(dict((k, self.formatted_val(k, v)) for k, v in self.kwargs.items()))
+        res.update(dict((k, self.formatted_val(k, v)) for k, v in self.rendered_items()))
+
+        if self.stack:
+            res["stack"] = self.stack_summary()
 
         if self.errors:
             res["errors"] = [repr(e) if not hasattr(e, "as_dict") else e.as_dict() for e in self.errors]
         return res
 
+    @render_scope
+    def structured(self):
+        """
+        Return a dictionary describing this error without combining it's parts into strings
+
+        Child errors are described with ``structured_error``.
+        """
+        kls = self.__class__
+        res = {
+              "class": "{0}.{1}".format(kls.__module__, getattr(kls, "__qualname__", kls.__name__))
+            , "fingerprint": self.fingerprint()
+            , "kwargs": dict((k, self.formatted_val(k, v)) for k, v in self.rendered_items())
+            }
+
+        if self.desc:
+            res["desc"] = self.desc
+        if self.message:
+            res["message"] = self.message
+        if self.stack:
+            res["stack"] = self.stack_summary()
+        if self.errors:
+            res["errors"] = [structured_error(e) for e in self.errors]
+        return res
+
+    def stack_summary(self):
+        """Return a list of strings saying where this error was created, innermost first"""
+        if not self.stack:
+            return []
+        # The stack is already strings if this error was unpickled
+        return [entry if isinstance(entry, six.string_types) else stack_location(*entry) for entry in self.stack]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if self.stack:
+            # Code objects can't be pickled
+            state["stack"] = tuple(self.stack_summary())
+        return state
+
+    def __reduce__(self):
+        return (self.__class__, self.args, self.__getstate__())
+
+    def fingerprint(self):
+        """
+        Return a string identifying this kind of error
+
+        This is made from the class, the message template and the names of the
+        kwargs, so that it's stable across processes and doesn't need the
+        error to be rendered.
+        """
+        kls = self.__class__
+        parts = [kls.__module__, getattr(kls, "__qualname__", kls.__name__), six.text_type(self.message_template)]
+        parts.extend(sorted(six.text_type(key) for key in self.kwargs))
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()[:16]
+
+    def with_kwargs(self, **kwargs):
+        """
+        Return a copy of this error with extra kwargs
+
+        The new error shares our kwargs rather than copying them, so changes to
+        this error's kwargs will be seen by the new error.
+        """
+        errors = kwargs.pop("_errors", None)
+
+        if ChainMap is None:
+            new_kwargs = dict(self.kwargs)
+            new_kwargs.update(kwargs)
+        elif isinstance(self.kwargs, ChainMap):
+            new_kwargs = ChainMap(kwargs, *self.kwargs.maps)
+        else:
+            new_kwargs = ChainMap(kwargs, self.kwargs)
+
+        if errors:
+            return self.derive(kwargs=new_kwargs, errors=ErrorsChain(self.errors, errors))
+        return self.derive(kwargs=new_kwargs)
+
+    def with_errors(self, *errors):
+        """
+        Return a copy of this error with extra errors
+
+        The new error shares our errors rather than copying them, so changes to
+        this error's errors will be seen by the new error.
+        """
+        return self.derive(errors=ErrorsChain(self.errors, errors))
+
+    def derive(self, **attrs):
+        """Make a copy of this error without calling __init__ and override some attributes"""
+        derived = self.__class__.__new__(self.__class__)
+        derived.args = self.args
+        derived.__dict__.update(self.__dict__)
+        derived.__dict__.update(attrs)
+        return derived
+
+    def as_exception_group(self):
+        """
+        Return an ExceptionGroup holding our errors
+
+        The group's message is our message without the kwargs, and the children
+        are not converted, so nested DelfickErrors stay as they are. Note that
+        ExceptionGroup will make a tuple of the errors.
+        """
+        if ExceptionGroup is None:
+            raise ProgrammerError("ExceptionGroup is only in python3.11+")
+
+        if not self.errors:
+            raise ProgrammerError("Can't make an ExceptionGroup without any errors")
+
+        not_exceptions = [error for error in self.errors if not isinstance(error, BaseException)]
+        if not_exceptions:
+            raise ProgrammerError("Can't make an ExceptionGroup from errors that aren't exceptions: {0}".format(not_exceptions))
+
+        return ExceptionGroup(six.text_type(self.message), self.errors)
+
+    @classmethod
+    def from_exception_group(kls, group, **kwargs):
+        """Create an instance of this class using the message and exceptions of an ExceptionGroup"""
+        return kls(group.message, _errors=group.exceptions, **kwargs)
+
+    def split(self, condition):
+        """
+        Like ExceptionGroup.split, return (match, rest) where match is a copy of
+        this error with only the errors that match the condition and rest is a
+        copy with the errors that don't.
+
+        Either may be None and parts of the tree that don't need to change are
+        reused rather than copied.
+
+        condition may be an exception class, a tuple of exception classes or a
+        function that takes in an error and returns a boolean.
+        """
+        if isinstance(condition, (type, tuple)):
+            kls = condition
+            condition = lambda error: isinstance(error, kls)
+
+        if condition(self):
+            return self, None
+
+        match = []
+        rest = []
+        for error in self.errors:
+            if isinstance(error, DelfickError) and error.errors:
+                m, r = error.split(condition)
+            elif ExceptionGroup is not None and isinstance(error, ExceptionGroup):
+                m, r = error.split(condition)
+            elif condition(error):
+                m, r = error, None
+            else:
+                m, r = None, error
+
+            if m is not None:
+                match.append(m)
+            if r is not None:
+                rest.append(r)
+
+        if not match:
+            return None, self
+        if not rest:
+            if all(m is e for m, e in zip(match, self.errors)):
+                return self, None
+            return self.derive(errors=match), None
+        return self.derive(errors=match), self.derive(errors=rest)
+
+    def subgroup(self, condition):
+        """Like ExceptionGroup.subgroup, return just the match from split"""
+        return self.split(condition)[0]
+
     def __unicode__(self):
         return str(self).decode("utf-8")
 
@@ -72,12 +770,13 @@ class DelfickError(Exception):
     def __hash__(self):
         return hash(self.as_tuple(for_hash=True))
 
+    @render_scope
     def oneline(self):
         """Get back the error as a oneliner"""
         desc = self.desc
         message = self.message
 
-        info = ["{0}={1}".format(k, self.formatted_val(k, v)) for k, v in sorted(self.kwargs.items())]
+        info = ["{0}={1}".format(k, self.formatted_val(k, v)) for k, v in sorted(self.rendered_items())]
         info = '\t'.join(info)
         if info and (message or desc):
             info = "\t{0}".format(info)
@@ -92,19 +791,80 @@ class DelfickError(Exception):
             else:
                 return "{0}".format(info)
 
+    def rendered_items(self):
+        """Return the (key, val) pairs to display, including any ambient kwargs"""
+        if not self.ambient_kwargs:
+            return self.kwargs.items()
+
+        kwargs = dict(self.ambient_kwargs)
+        kwargs.update(self.kwargs)
+        return kwargs.items()
+
+    def resolved_val(self, key, val):
+        """Resolve a Lazy value, or return a placeholder if it fails to resolve"""
+        if not isinstance(val, Lazy):
+            return val
+
+        try:
+            return val.resolve()
+        except Exception as error:
+            return render_placeholder("<|Failed to resolve lazy val for exception: key={0}, error={1}|>".format(key, error))
+
     def formatted_val(self, key, val):
         """Format a value for display in error message"""
+        val = self.resolved_val(key, val)
         if not hasattr(val, "delfick_error_format"):
             return val
+
+        # render_many shares formatted values between the errors it renders
+        formatted = getattr(_render_state, "formatted", None)
+        if formatted is not None:
+            cached = formatted.get((key, id(val)))
+            if cached is not None and cached[0] is val:
+                if cached[2]:
+                    _render_state.placeholders = True
+                return cached[1]
+
+        outer = getattr(_render_state, "placeholders", False)
+        _render_state.placeholders = False
+        if self.format_budget is not None:
+            result = self.formatted_val_with_budget(key, val)
         else:
             try:
-                return val.delfick_error_format(key)
+                result = val.delfick_error_format(key)
             except Exception as error:
-                return "<|Failed to format val for exception: val={0}, error={1}|>".format(val, error)
+                result = render_placeholder("<|Failed to format val for exception: val={0}, error={1}|>".format(val, error))
+
+        placeholder = _render_state.placeholders
+        _render_state.placeholders = outer or placeholder
+
+        if formatted is not None:
+            if len(formatted) >= 10000:
+                formatted.clear()
+            formatted[(key, id(val))] = (val, result, placeholder)
+        return result
+
+    def formatted_val_with_budget(self, key, val):
+        """Format a value, giving up if it takes longer than format_budget"""
+        slow = getattr(_render_state, "slow", None)
+        if slow is not None and val.__class__ in slow:
+            return render_placeholder("<|Skipped slow format for exception: key={0}, type={1}|>".format(key, val.__class__.__name__))
+
+        try:
+            finished, result = hook_runner.run(self.format_budget, val.delfick_error_format, key)
+        except Exception as error:
+            return render_placeholder("<|Failed to format val for exception: val={0}, error={1}|>".format(val, error))
+
+        if finished:
+            return result
+
+        if slow is not None:
+            slow.add(val.__class__)
+        return render_placeholder("<|Timed out formatting val for exception: key={0}, type={1}, budget={2}|>".format(key, val.__class__.__name__, self.format_budget))
 
     def __eq__(self, error):
         """Say whether this error is like the other error"""
-        if error.__class__ != self.__class__ or error.message != self.message:
+        if error.__class__ != self.__class__ or error.message_key() != self.message_key():
             return False
 
         self_kwargs = self.as_tuple(formatted=True)[2]
@@ -115,7 +875,7 @@ class DelfickError(Exception):
         return self.as_tuple(formatted=True) < error.as_tuple(formatted=True)
 
     def as_tuple(self, for_hash=False, formatted=False):
-        kwarg_items = sorted(self.kwargs.items())
+        kwarg_items = sorted((key, self.resolved_val(key, val)) for key, val in self.kwargs.items())
         if formatted:
             final = []
             for key, val in kwarg_items:
@@ -126,7 +886,11 @@ class DelfickError(Exception):
             kwarg_items = sorted(final)
         if for_hash:
             kwarg_items = [(key, str(val)) for key, val in kwarg_items]
-        return (self.__class__.__name__, self.message, tuple(kwarg_items), tuple(self.errors))
+        if for_hash:
+            message = (self.message_template, tuple(hashable_val(arg) for arg in self.message_args))
+        else:
+            message = self.message
+        return (self.__class__.__name__, message, tuple(kwarg_items), tuple(self.errors))
 
 class ProgrammerError(Exception):
     """For when the programmer should have prevented something happening"""
@@ -138,6 +902,317 @@ class UserQuit(DelfickError):
     """Raise this if the user quit the application"""
     desc = "User Quit"
 
+class InvalidRecord(DelfickError):
+    """Used by validate_stream to hold failures that aren't a DelfickError"""
+    desc = "Invalid record"
+
+class FrozenDelfickError(DelfickError):
+    """
+    A DelfickError that can't be changed after it's made.
+
+    The kwargs are a read only mapping and the errors are a tuple, so the hash,
+    fingerprint and rendered forms of the error are only worked out once.
+    Renders that had to use a placeholder, for example because a
+    ``delfick_error_format`` hook ran out of it's ``format_budget``, aren't
+    remembered so that a later render may try again.
+    """
+    # Attributes that are still set after the error is made
+    unfrozen_attributes = ("_message", "traceback_summary")
+
+    def __init__(self, message="", *message_args, **kwargs):
+        super(FrozenDelfickError, self).__init__(message, *message_args, **kwargs)
+        self.freeze()
+
+    def freeze(self):
+        """Make our kwargs and errors read only, forget anything we cached and stop any changes"""
+        if not isinstance(self.kwargs, MappingProxyType):
+            self.__dict__["kwargs"] = MappingProxyType(self.kwargs)
+        if not isinstance(self.errors, (tuple, ErrorsChain)):
+            self.__dict__["errors"] = tuple(self.errors)
+        self.__dict__["_cache"] = {}
+        self.__dict__["_frozen"] = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get("_frozen"):
+            if not (name.startswith("__") and name.endswith("__")) and name not in self.unfrozen_attributes:
+                raise AttributeError("Can't set {0} on a frozen error".format(name))
+        super(FrozenDelfickError, self).__setattr__(name, value)
+
+    def __delattr__(self, name):
+        if self.__dict__.get("_frozen"):
+            raise AttributeError("Can't delete {0} from a frozen error".format(name))
+        super(FrozenDelfickError, self).__delattr__(name)
+
+    def derive(self, **attrs):
+        derived = super(FrozenDelfickError, self).derive(**attrs)
+        derived.freeze()
+        return derived
+
+    def __reduce__(self):
+        state = self.__getstate__()
+        state["kwargs"] = dict(self.kwargs)
+        state["errors"] = list(self.errors)
+        del state["_cache"]
+        del state["_frozen"]
+        return (restore_frozen_error, (self.__class__, self.args, state))
+
+    def cached(self, name, func):
+        cache = self.__dict__["_cache"]
+        if name in cache:
+            return cache[name]
+
+        outer = getattr(_render_state, "placeholders", False)
+        _render_state.placeholders = False
+        try:
+            result = func()
+            if not _render_state.placeholders:
+                cache[name] = result
+        finally:
+            _render_state.placeholders = outer or _render_state.placeholders
+        return result
+
+    def __hash__(self):
+        return self.cached("hash", super(FrozenDelfickError, self).__hash__)
+
+    def fingerprint(self):
+        return self.cached("fingerprint", super(FrozenDelfickError, self).fingerprint)
+
+    def oneline(self):
+        return self.cached("oneline", super(FrozenDelfickError, self).oneline)
+
+    def __str__(self):
+        return self.cached("str", super(FrozenDelfickError, self).__str__)
+
+def restore_frozen_error(kls, args, state):
+    """Used to unpickle a FrozenDelfickError without calling __init__ again"""
+    error = kls.__new__(kls)
+    error.args = args
+    error.__dict__.update(state)
+    error.freeze()
+    return error
+
+def structured_error(error):
+    """
+    Return a dictionary describing an error
+
+    DelfickErrors are described by their ``structured`` method, other exceptions
+    by their class and string and anything else by it's repr.
+    """
+    if hasattr(error, "structured"):
+        return error.structured()
+    elif isinstance(error, BaseException):
+        kls = error.__class__
+        return {"class": "{0}.{1}".format(kls.__module__, getattr(kls, "__qualname__", kls.__name__)), "message": str(error)}
+    else:
+        return {"repr": repr(error)}
+
+class MatchDiff(object):
+    """
+    The difference between what was expected and what we got.
+
+    The string of the diff only shows up to limit items of each kind.
+    """
+    def __init__(self, missing=(), unexpected=(), mismatched=(), limit=10):
+        self.limit = limit
+        self.missing = missing
+        self.unexpected = unexpected
+        self.mismatched = mismatched
+
+    def __bool__(self):
+        return bool(self.missing or self.unexpected or self.mismatched)
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        parts = []
+        if self.missing:
+            parts.append("Missing: {0}".format(self.bounded(safe_repr(item, short=True) for item in self.missing)))
+        if self.unexpected:
+            parts.append("Unexpected: {0}".format(self.bounded(safe_repr(item, short=True) for item in self.unexpected)))
+        if self.mismatched:
+            parts.append("Mismatched: {0}".format(self.bounded(
+                  "{{{0}: expected={1}, got={2}}}".format(safe_repr(key), safe_repr(want, short=True), safe_repr(got, short=True))
+                  for key, want, got in self.mismatched
+                )))
+        return "; ".join(parts)
+
+    def bounded(self, items):
+        items = sorted(items)
+        shown = ", ".join(items[:self.limit])
+        if len(items) > self.limit:
+            shown = "{0}, ... and {1} more".format(shown, len(items) - self.limit)
+        return shown
+
+def kwargs_diff(expected, actual, limit=10):
+    """
+    Return a MatchDiff if actual doesn't have all the keys and values in expected
+
+    Return None if it does, without making any diff.
+    """
+    missing = None
+    mismatched = None
+    for key, value in expected.items():
+        if key not in actual:
+            missing = missing or []
+            missing.append(key)
+        elif value != resolved(actual[key]):
+            mismatched = mismatched or []
+            mismatched.append((key, value, resolved(actual[key])))
+
+    if missing or mismatched:
+        return MatchDiff(missing=missing, mismatched=mismatched, limit=limit)
+
+def errors_diff(expected, actual, limit=10):
+    """
+    Return a MatchDiff if expected and actual don't have the same errors in any order
+
+    Errors are put into buckets so that each error is first compared against
+    errors that are likely to be equal to it. Because equality may be looser
+    than the bucket, for example with ``mock.ANY`` in kwargs, an error that
+    isn't found in it's bucket is then compared against every remaining error.
+    Return None if they match, without making any diff.
+    """
+    def bucket(error):
+        if isinstance(error, DelfickError):
+            # Everything that goes into the hash except the errors, which may be in any order
+            return (error.__class__, ) + error.as_tuple(for_hash=True, formatted=True)[1:3]
+        try:
+            return hash(error)
+        except TypeError:
+            return error.__class__
+
+    buckets = {}
+    for error in actual:
+        buckets.setdefault(bucket(error), []).append(error)
+
+    def take(candidates, error):
+        for index, candidate in enumerate(candidates):
+            if candidate == error:
+                del candidates[index]
+                return True
+        return False
+
+    # Take the matches from the buckets first so the loose matches that follow
+    # can't take an error that something else matches exactly
+    leftover = [error for error in expected if not take(buckets.get(bucket(error), ()), error)]
+
+    missing = None
+    for error in leftover:
+        if not any(take(candidates, error) for candidates in buckets.values()):
+            missing = missing or []
+            missing.append(error)
+
+    unexpected = [error for candidates in buckets.values() for error in candidates]
+    if missing or unexpected:
+        return MatchDiff(missing=missing, unexpected=unexpected, limit=limit)
+
+class ErrorCollector(object):
+    """
+    Collect errors into one DelfickError
+
+    .. code-block:: python
+
+        collector = ErrorCollector(DelfickError, "Failed to process things")
+        for thing in things:
+            try:
+                process(thing)
+            except Exception as error:
+                collector.add(error)
+        collector.raise_errors()
+
+    If max_errors is given then only that many errors are kept and the rest are
+    only counted. The final error says how many were dropped.
+    """
+    def __init__(self, error_kls=DelfickError, message="", detach_tracebacks=False, max_errors=None, **kwargs):
+        self.kwargs = kwargs
+        self.message = message
+        self.error_kls = error_kls
+        self.max_errors = max_errors
+        self.detach_tracebacks = detach_tracebacks
+        self.errors = []
+        self.total = 0
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __bool__(self):
+        return self.total > 0
+    __nonzero__ = __bool__
+
+    @property
+    def dropped(self):
+        """How many errors were counted but not kept"""
+        return self.total - len(self.errors)
+
+    def add(self, error):
+        """Collect an error"""
+        self.total += 1
+        if self.max_errors is not None and len(self.errors) >= self.max_errors:
+            return
+
+        if self.detach_tracebacks:
+            detach_traceback(error)
+        self.errors.append(error)
+
+    def error(self):
+        """Return an error_kls holding all the collected errors"""
+        kwargs = self.kwargs
+        if self.dropped:
+            kwargs = dict(kwargs, dropped=self.dropped)
+        return self.error_kls(self.message, _errors=self.errors, **kwargs)
+
+    def raise_errors(self):
+        """Raise an error_kls holding the collected errors if we have any"""
+        if self:
+            raise self.error()
+
+def validate_stream(records, checks, collector, max_failures=None, location=None):
+    """
+    Yield the records that pass every check and add failures to the collector
+
+    .. code-block:: python
+
+        collector = ErrorCollector(DelfickError, "Bad rows", max_errors=100, detach_tracebacks=True)
+        for row in validate_stream(csv.reader(f), [has_name, has_email], collector, max_failures=1000):
+            save(row)
+        collector.raise_errors()
+
+    Each check is called with the record and raises an error if the record
+    isn't valid. Every check is run on every record and each failure has the
+    location of the record added to its kwargs. By default the location is
+    ``index=<position in records>``, or pass ``location(index, record)`` to
+    return a dictionary of something else. Failures that aren't a DelfickError
+    are wrapped in an ``InvalidRecord``.
+
+    Records are only pulled from ``records`` as we are iterated, so nothing is
+    buffered and the collector's max_errors keeps memory bounded for any number
+    of records. We stop early once max_failures records have failed.
+    """
+    failed = 0
+    for index, record in enumerate(records):
+        valid = True
+        for check in checks:
+            try:
+                check(record)
+            except Exception as error:
+                if valid:
+                    valid = False
+                    failed += 1
+                    found = location(index, record) if location else {"index": index}
+
+                if collector.detach_tracebacks:
+                    # Before we wrap or copy it, so the summary comes along
+                    detach_traceback(error)
+
+                if isinstance(error, DelfickError):
+                    collector.add(error.with_kwargs(**found))
+                else:
+                    collector.add(InvalidRecord(_errors=[error], **found))
+
+        if valid:
+            yield record
+        elif max_failures is not None and failed >= max_failures:
+            return
+
 class DelfickErrorTestMixin:
     @contextmanager
     def fuzzyAssertRaisesError(self, expected_kls, expected_msg_regex=NotSpecified, **values):
@@ -171,7 +1246,9 @@ class DelfickErrorTestMixin:
 
                     self.assertDictContains(values, error.kwargs)
                     if errors:
-                        self.assertEqual(sorted(error.errors), sorted(errors))
+                        diff = errors_diff(errors, error.errors)
+                        if diff:
+                            self.fail("Errors are different: {0}".format(diff))
             except AssertionError:
                 exc_info = sys.exc_info()
                 try:
@@ -195,35 +1272,20 @@ class DelfickErrorTestMixin:
 
     def assertDictContains(self, expected, actual, msg=None):
         """Checks whether actual is a superset of expected."""
-        missing = []
-        mismatched = []
-        for key, value in expected.items():
-            if key not in actual:
-                missing.append(safe_repr(key))
-            elif value != actual[key]:
-                nxt = "{{{0}: expected={1}, got={2}}}".format(safe_repr(key), safe_repr(value), safe_repr(actual[key]))
-                mismatched.append(nxt)
-
-        if not (missing or mismatched):
+        diff = kwargs_diff(expected, actual)
+        if not diff:
             return
 
-        error = []
-        if missing:
-            error.append("Missing: {0}".format(', '.join(sorted(missing))))
-
-        if mismatched:
-            error.append("Mismatched: {0}".format(', '.join(sorted(mismatched))))
-
         if hasattr(self, "_formatMessage"):
-            self.fail(self._formatMessage(msg, '; '.join(error)))
+            self.fail(self._formatMessage(msg, str(diff)))
         else:
-            self.fail(msg or '; '.join(error))
+            self.fail(msg or str(diff))
 
     def assertMatchingRegex(self, text, expected_regex, msg=None):
         """Fail the test unless the text matches the regular expression."""
         if isinstance(expected_regex, (str, bytes)):
             assert expected_regex, "expected_regex must not be empty."
-            expected_regex = re.compile(expected_regex)
+            expected_regex = compiled_regex(expected_regex)
         if not expected_regex.search(text):
             msg = msg or "Regex didn't match"
             msg = '%s: %r not found in %r' % (msg, expected_regex.pattern, text)
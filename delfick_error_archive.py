@@ -0,0 +1,189 @@
+"""
+An append only archive of errors on disk.
+
+The archive is two files. The data file holds each error as json made by
+``delfick_error.structured_error``. The index file, at the same path with
+``.idx`` on the end, holds a fixed size entry for each error saying when it
+was archived, where it is in the data file, it's fingerprint and a hash of
+it's class.
+
+Readers use mmap on both files so finding errors doesn't load the whole
+archive into memory.
+
+Only one process may write to an archive at a time, as each writer assumes
+it's the only one appending to the data file.
+"""
+from delfick_error import structured_error
+
+from collections import namedtuple
+import hashlib
+import struct
+import json
+import mmap
+import time
+import os
+
+DATA_MAGIC = b"DELFICKERRORS1\n"
+INDEX_MAGIC = b"DELFICKERRORSIDX1\n"
+
+# created, offset, length, fingerprint, class hash
+index_entry = struct.Struct("<dQI8s8s")
+
+ArchivedError = namedtuple("ArchivedError", ["created", "fingerprint", "class_name", "data"])
+
+def class_name_of(error):
+    kls = error.__class__
+    return f"{kls.__module__}.{kls.__qualname__}"
+
+def class_hash(class_name):
+    return hashlib.sha1(class_name.encode("utf-8")).digest()[:8]
+
+def fingerprint_of(error):
+    if hasattr(error, "fingerprint"):
+        return error.fingerprint()
+    return hashlib.sha1(class_name_of(error).encode("utf-8")).hexdigest()[:16]
+
+class ErrorArchiveWriter:
+    """
+    Append errors to an archive.
+
+    Only one writer may have an archive open at a time. A partial index entry
+    left by a writer that crashed is removed when the archive is opened.
+
+    .. code-block:: python
+
+        with ErrorArchiveWriter("errors.archive") as archive:
+            archive.append(error)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = self.open_file(path, DATA_MAGIC)
+        self.index = self.open_file(f"{path}.idx", INDEX_MAGIC)
+
+        # A crash part way through writing an entry would misalign every entry after it
+        size = self.index.tell()
+        whole = len(INDEX_MAGIC) + (size - len(INDEX_MAGIC)) // index_entry.size * index_entry.size
+        if size != whole:
+            self.index.truncate(whole)
+
+    def open_file(self, path, magic):
+        f = open(path, "ab")
+        if f.tell() == 0:
+            f.write(magic)
+            f.flush()
+        return f
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+    def append(self, error, created=None):
+        """Add this error to the archive"""
+        if created is None:
+            created = time.time()
+
+        class_name = class_name_of(error)
+        fingerprint = fingerprint_of(error)
+        payload = json.dumps(
+              {"created": created, "fingerprint": fingerprint, "class": class_name, "error": structured_error(error)}
+            , separators=(",", ":")
+            , default=str
+            ).encode("utf-8")
+
+        offset = self.data.tell()
+        self.data.write(payload)
+        self.data.flush()
+
+        # The index entry goes in after the data so readers never see an entry without it's data
+        self.index.write(index_entry.pack(created, offset, len(payload), bytes.fromhex(fingerprint), class_hash(class_name)))
+        self.index.flush()
+
+class ErrorArchiveReader:
+    """
+    Find errors in an archive.
+
+    Only errors archived before the reader was opened are seen.
+
+    .. code-block:: python
+
+        with ErrorArchiveReader("errors.archive") as archive:
+            for archived in archive.by_fingerprint(error.fingerprint()):
+                ...
+    """
+    def __init__(self, path):
+        self.path = path
+        self.data = self.open_map(path, DATA_MAGIC)
+        self.index = self.open_map(f"{path}.idx", INDEX_MAGIC)
+        self.fingerprints = None
+
+    def open_map(self, path, magic):
+        with open(path, "rb") as f:
+            if f.read(len(magic)) != magic:
+                raise ValueError(f"{path} is not an error archive")
+            if os.fstat(f.fileno()).st_size == len(magic):
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        for m in (self.data, self.index):
+            if m is not None:
+                m.close()
+
+    def __len__(self):
+        if self.index is None:
+            return 0
+        return (len(self.index) - len(INDEX_MAGIC)) // index_entry.size
+
+    def entries(self):
+        """Yield (number, created, offset, length, fingerprint, class hash) for each entry in the index"""
+        if self.index is None:
+            return
+
+        for number in range(len(self)):
+            yield (number, ) + index_entry.unpack_from(self.index, len(INDEX_MAGIC) + number * index_entry.size)
+
+    def read(self, offset, length):
+        """Return the ArchivedError at this part of the data file"""
+        record = json.loads(self.data[offset:offset + length])
+        return ArchivedError(record["created"], record["fingerprint"], record["class"], record["error"])
+
+    def __iter__(self):
+        for _, _, offset, length, _, _ in self.entries():
+            yield self.read(offset, length)
+
+    def by_fingerprint(self, fingerprint):
+        """Yield the archived errors with this fingerprint"""
+        if self.fingerprints is None:
+            self.fingerprints = {}
+            for _, _, offset, length, fp, _ in self.entries():
+                self.fingerprints.setdefault(fp, []).append((offset, length))
+
+        for offset, length in self.fingerprints.get(bytes.fromhex(fingerprint), ()):
+            yield self.read(offset, length)
+
+    def by_class(self, class_name):
+        """Yield the archived errors of this class, where class_name is ``module.QualName``"""
+        want = class_hash(class_name)
+        for _, _, offset, length, _, hashed in self.entries():
+            if hashed == want:
+                archived = self.read(offset, length)
+                if archived.class_name == class_name:
+                    yield archived
+
+    def between(self, start=None, end=None):
+        """Yield the archived errors created from start up to but not including end"""
+        for _, created, offset, length, _, _ in self.entries():
+            if (start is None or created >= start) and (end is None or created < end):
+                yield self.read(offset, length)
@@ -0,0 +1,107 @@
+from delfick_error import DelfickError, ErrorCollector, ProgrammerError
+
+import asyncio
+
+async def gather_errors(awaitables, limit=None, max_failures=None, message="", error_kls=DelfickError, detach_tracebacks=False, max_errors=None, **kwargs):
+    """
+    Await all the awaitables and return their results in order.
+
+    Failures are collected as they complete and raised together as one
+    error_kls with the failures as it's ``_errors``. Awaitables that are
+    cancelled by something else are collected as an ``asyncio.CancelledError``.
+
+    awaitables
+        An iterable of awaitables. These are only taken from the iterable as
+        there is room for them to run.
+
+    limit
+        The maximum number of awaitables to run at the same time. Must be at
+        least 1.
+
+    max_failures
+        Cancel everything that is still running and stop taking awaitables
+        once this many have failed.
+
+    detach_tracebacks
+        Remove the tracebacks from failures as they are collected so we don't
+        hold onto their frames. See ``delfick_error.detach_traceback``.
+
+    max_errors
+        Only keep this many failures and count the rest. See
+        ``delfick_error.ErrorCollector``.
+
+    message and kwargs
+        Given to the error_kls that is raised.
+
+    .. code-block:: python
+
+        from delfick_error_asyncio import gather_errors
+
+        results = await gather_errors((fetch(url) for url in urls), limit=100, message="Failed to fetch")
+    """
+    if limit is not None and limit < 1:
+        raise ProgrammerError(f"limit must be at least 1, got {limit}")
+
+    collector = ErrorCollector(error_kls, message, detach_tracebacks=detach_tracebacks, max_errors=max_errors, **kwargs)
+
+    results = {}
+    pending = {}
+    iterator = enumerate(awaitables)
+    exhausted = False
+    stopped = False
+
+    def fill():
+        nonlocal exhausted
+        while not exhausted and not stopped and (limit is None or len(pending) < limit):
+            try:
+                index, awaitable = next(iterator)
+            except StopIteration:
+                exhausted = True
+            else:
+                pending[asyncio.ensure_future(awaitable)] = index
+
+    def stop():
+        nonlocal stopped
+        stopped = True
+        for task in pending:
+            task.cancel()
+
+        if hasattr(awaitables, "close"):
+            # Don't make the generator create awaitables we won't use
+            awaitables.close()
+        else:
+            # Make sure we don't leave behind coroutines that were never awaited
+            for _, awaitable in iterator:
+                if asyncio.iscoroutine(awaitable):
+                    awaitable.close()
+
+    try:
+        fill()
+        while pending:
+            done, _ = await asyncio.wait(list(pending), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index = pending.pop(task)
+                if task.cancelled():
+                    if stopped:
+                        continue
+                    # Cancelled by something other than us
+                    exc = asyncio.CancelledError()
+                else:
+                    exc = task.exception()
+
+                if exc is None:
+                    results[index] = task.result()
+                    continue
+
+                collector.add(exc)
+                if max_failures is not None and collector.total >= max_failures and not stopped:
+                    stop()
+
+            fill()
+    finally:
+        if pending:
+            stop()
+            await asyncio.wait(list(pending))
+
+    collector.raise_errors()
+    return [results[index] for index in sorted(results)]
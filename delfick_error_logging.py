@@ -0,0 +1,139 @@
+from delfick_error import DelfickError, structured_error
+
+from collections import OrderedDict
+import threading
+import traceback
+import logging
+import json
+import time
+
+def error_from_record(record):
+    """Return the DelfickError being logged by this record, or None if there isn't one"""
+    if record.exc_info and isinstance(record.exc_info[1], DelfickError):
+        return record.exc_info[1]
+    if isinstance(record.msg, DelfickError):
+        return record.msg
+
+class DedupFilter(logging.Filter):
+    """
+    A logging filter that lets through at most one record for each kind of
+    DelfickError per interval.
+
+    Errors are grouped by ``DelfickError.fingerprint()``, so suppressed records
+    are never formatted. Records that are let through get
+    ``delfick_error_fingerprint`` and ``delfick_error_suppressed`` attributes,
+    the latter being how many records were suppressed since the last one for
+    that fingerprint was let through.
+
+    Records without a DelfickError are always let through.
+
+    The suppressed count is only reported by the next record let through for
+    that fingerprint, so the count from the end of a storm isn't seen until
+    that error happens again. Use ``flush`` to get those counts, for example
+    periodically or when the application shuts down.
+
+    .. code-block:: python
+
+        dedup = DedupFilter(interval=60)
+        handler.addFilter(dedup)
+        ...
+        for fingerprint, suppressed in dedup.flush(force=True).items():
+            log.warning("Suppressed %d errors with fingerprint %s", suppressed, fingerprint)
+    """
+    def __init__(self, interval=60, max_fingerprints=10000, clock=time.monotonic):
+        super().__init__()
+        self.clock = clock
+        self.interval = interval
+        self.max_fingerprints = max_fingerprints
+
+        self.lock = threading.Lock()
+        self.seen = OrderedDict()
+
+    def filter(self, record):
+        error = error_from_record(record)
+        if error is None:
+            return True
+
+        fingerprint = error.fingerprint()
+        now = self.clock()
+
+        with self.lock:
+            state = self.seen.get(fingerprint)
+            if state is not None and now - state[0] < self.interval:
+                state[1] += 1
+                return False
+
+            suppressed = 0 if state is None else state[1]
+            self.seen[fingerprint] = [now, 0]
+            self.seen.move_to_end(fingerprint)
+            while len(self.seen) > self.max_fingerprints:
+                self.seen.popitem(last=False)
+
+        record.delfick_error_fingerprint = fingerprint
+        record.delfick_error_suppressed = suppressed
+        return True
+
+    def flush(self, force=False):
+        """
+        Return ``{fingerprint: suppressed}`` for the fingerprints that have had
+        records suppressed and whose interval has ended, and reset those counts.
+
+        If force is True then counts are returned even if the interval for that
+        fingerprint hasn't ended yet.
+        """
+        now = self.clock()
+        flushed = {}
+        with self.lock:
+            for fingerprint, state in self.seen.items():
+                if state[1] and (force or now - state[0] >= self.interval):
+                    flushed[fingerprint] = state[1]
+                    state[1] = 0
+        return flushed
+
+class JsonFormatter(logging.Formatter):
+    """
+    A logging formatter that outputs each record as one line of json.
+
+    If the record is logging a DelfickError then the error is included as an
+    ``error`` field made by ``delfick_error.structured_error`` rather than as
+    a string. Any ``exc_info`` and ``stack_info`` are included as strings,
+    with only the traceback frames when the exception is that DelfickError.
+
+    .. code-block:: python
+
+        handler.setFormatter(JsonFormatter())
+
+    Values that can't be represented in json are converted with str.
+    """
+    def format(self, record):
+        data = {
+              "created": record.created
+            , "level": record.levelname
+            , "logger": record.name
+            }
+
+        error = error_from_record(record)
+        if error is not None and record.msg is error and not record.args:
+            # Don't turn the whole error into a string just for the message
+            data["msg"] = error.message
+        else:
+            data["msg"] = record.getMessage()
+
+        if error is not None:
+            data["error"] = structured_error(error)
+
+        if record.exc_info and record.exc_info[1] is error:
+            # The error is already in data["error"], so only the frames are needed
+            data["exc_info"] = "Traceback (most recent call last):\n{0}".format("".join(traceback.format_tb(record.exc_info[2]))).rstrip("\n")
+        elif record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            data["exc_info"] = record.exc_text
+
+        if record.stack_info:
+            data["stack_info"] = self.formatStack(record.stack_info)
+
+        if hasattr(record, "delfick_error_suppressed"):
+            data["suppressed"] = record.delfick_error_suppressed
+
+        return json.dumps(data, default=str)
@@ -0,0 +1,95 @@
+from delfick_error import add_construction_hook, remove_construction_hook, Lazy
+
+from collections import Counter
+import threading
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class ErrorMetrics:
+    """
+    Count every DelfickError that is created, by class and by the values of
+    some allowed kwargs, and render those counts in the Prometheus text format.
+
+    Each thread counts into it's own dictionary so that counting doesn't need a lock.
+
+    .. code-block:: python
+
+        metrics = ErrorMetrics(labels=["stage"]).enable()
+        ...
+        body = metrics.render()
+
+    Only kwargs with low cardinality should be used as labels. Labels use the
+    str of the kwarg without formatting it, and ``Lazy`` kwargs are left
+    unresolved and given an empty label.
+    """
+    def __init__(self, labels=(), name="delfick_errors_total"):
+        self.name = name
+        self.labels = tuple(labels)
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters = []
+
+    def enable(self):
+        """Start counting errors"""
+        add_construction_hook(self.record)
+        return self
+
+    def disable(self):
+        """Stop counting errors"""
+        remove_construction_hook(self.record)
+
+    def __enter__(self):
+        return self.enable()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.disable()
+
+    def record(self, error):
+        """Count this error"""
+        try:
+            counts = self.local.counts
+        except AttributeError:
+            counts = self.local.counts = {}
+            with self.lock:
+                self.counters.append(counts)
+
+        key = (error.__class__.__name__, )
+        if self.labels:
+            key += tuple(self.label_value(error, label) for label in self.labels)
+        counts[key] = counts.get(key, 0) + 1
+
+    def label_value(self, error, label):
+        # We're called as the error is created, so don't do any expensive formatting
+        if label not in error.kwargs:
+            return ""
+
+        val = error.kwargs[label]
+        if isinstance(val, Lazy):
+            return ""
+        return str(val)
+
+    def totals(self):
+        """Return a Counter of (error_class, *label values) to count"""
+        with self.lock:
+            counters = list(self.counters)
+
+        totals = Counter()
+        for counts in counters:
+            totals.update(counts.copy())
+        return totals
+
+    def render(self):
+        """Return the counts in the Prometheus text exposition format"""
+        lines = [
+              f"# HELP {self.name} Number of DelfickErrors created"
+            , f"# TYPE {self.name} counter"
+            ]
+
+        names = ("error_class", ) + self.labels
+        for key, count in sorted(self.totals().items()):
+            labels = ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, key))
+            lines.append(f"{self.name}{{{labels}}} {count}")
+
+        return "\n".join(lines) + "\n"
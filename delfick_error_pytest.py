@@ -1,13 +1,16 @@
-from delfick_error import DelfickError
+from delfick_error import (
+      DelfickError, compiled_regex, errors_diff, kwargs_diff, detach_traceback
+    , add_construction_hook, remove_construction_hook
+    )
 
 from textwrap import dedent
 import traceback
+import pytest
 import sys
-import re
 
 class RegexCompare:
     def __init__(self, regex):
-        self.r = re.compile(regex)
+        self.r = compiled_regex(regex)
 
     def __eq__(self, other):
         return self.r.match(other) is not None
@@ -19,17 +22,21 @@ class Empty:
     def __repr__(self):
         return "<EMPTY>"
 
-class assertRaises:
+class Expectation:
     """
-    Assert that something raises a particular type of error.
+    What we expect of an error.
 
-    The error raised must be a subclass of the expected_kls
-    Have a message that matches the specified regex.
+    This takes the same arguments as assertRaises and does the work of
+    compiling the regex once so that it may be used for many checks.
 
-    And have atleast the values specified in it's kwargs.
+    .. code-block:: python
 
-    This is the same as fuzzyAssertRaisesError in DelfickErrorTestMixin
-    but more suitable to use in pytest.
+        expected = Expectation(MyErrorClass, "some regex", param1="value")
+
+        @pytest.mark.parametrize("value", values)
+        def test_it(value):
+            with assertRaises(expected):
+                ...
     """
     def __init__(self, expected_kls, expected_msg_regex=Empty, **values):
         self.values = values
@@ -40,7 +47,48 @@ class assertRaises:
 
         self.errors = None
         if "_errors" in self.values:
-            self.errors = self.values.pop("_errors")
+            self.errors = list(self.values.pop("_errors"))
+
+    def check(self, error):
+        """Raise an AssertionError if this error isn't what we expect"""
+        __tracebackhide__ = True
+        assertSameError(error, self.expected_kls, self.expected_msg_regex, self.values, self.errors)
+
+    def matches(self, error):
+        """Return whether this error is what we expect"""
+        try:
+            self.check(error)
+        except AssertionError:
+            return False
+        return True
+
+    def __repr__(self):
+        return f"<Expectation {self.expected_kls.__name__}: {self.expected_msg_regex}: {self.values}: {self.errors}>"
+
+class assertRaises:
+    """
+    Assert that something raises a particular type of error.
+
+    The error raised must be a subclass of the expected_kls
+    Have a message that matches the specified regex.
+
+    And have atleast the values specified in it's kwargs.
+
+    This is the same as fuzzyAssertRaisesError in DelfickErrorTestMixin
+    but more suitable to use in pytest.
+
+    An Expectation may be given instead of the arguments for one.
+    """
+    def __init__(self, expected_kls, expected_msg_regex=Empty, **values):
+        if isinstance(expected_kls, Expectation):
+            self.expectation = expected_kls
+        else:
+            self.expectation = Expectation(expected_kls, expected_msg_regex, **values)
+
+        self.values = self.expectation.values
+        self.errors = self.expectation.errors
+        self.expected_kls = self.expectation.expected_kls
+        self.expected_msg_regex = self.expectation.expected_msg_regex
 
     def __enter__(self):
         return
@@ -58,7 +106,7 @@ class assertRaises:
             """).strip()
 
         try:
-            assertSameError(exc, self.expected_kls, self.expected_msg_regex, self.values, self.errors)
+            self.expectation.check(exc)
         except:
             assertion = sys.exc_info()[1]
 
@@ -101,12 +149,72 @@ def assertSameError(error, expected_kls, expected_msg_regex, values, errors):
         if expected_msg_regex is not Empty:
             assert expected_msg_regex == error.message, "Incorrect message"
 
-        want_keys = set(values)
-        got_keys = set(error.kwargs)
-        assert want_keys <= got_keys, "Missing values"
-
-        got_subset = {k: v for k, v in error.kwargs.items() if k in want_keys}
-        assert values == got_subset, "Mismatched values"
+        diff = kwargs_diff(values, error.kwargs)
+        if diff:
+            assert not diff.missing, f"Missing values ({diff})"
+            assert False, f"Mismatched values ({diff})"
 
         if errors:
-            assert sorted(error.errors) == sorted(errors), "Errors list is different"
+            diff = errors_diff(errors, error.errors)
+            assert not diff, f"Errors list is different ({diff})"
+
+class ErrorCapture:
+    """
+    Record every DelfickError that is created while we are active.
+
+    Errors are recorded as they are created, so this includes errors that are
+    caught and never seen by the test. Use as a context manager or with the
+    ``delfick_errors`` fixture.
+
+    When we are finished the tracebacks of the recorded errors are replaced
+    with a summary, so we don't keep alive the frames of every error that was
+    raised and caught. See ``delfick_error.detach_traceback``.
+    """
+    def __init__(self):
+        self.errors = []
+
+    def __enter__(self):
+        add_construction_hook(self.errors.append)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        remove_construction_hook(self.errors.append)
+        for error in self.errors:
+            # Leave the error that is leaving the with block alone
+            if error is not exc:
+                detach_traceback(error)
+
+    def __len__(self):
+        return len(self.errors)
+
+    def __iter__(self):
+        return iter(self.errors)
+
+    def matching(self, expected_kls, expected_msg_regex=Empty, **values):
+        """
+        Return the errors that match, using the same rules as assertRaises.
+
+        An Expectation may be given instead of the arguments for one.
+        """
+        if isinstance(expected_kls, Expectation):
+            expectation = expected_kls
+        else:
+            expectation = Expectation(expected_kls, expected_msg_regex, **values)
+        return [error for error in self.errors if expectation.matches(error)]
+
+    def assertCreated(self, expected_kls, expected_msg_regex=Empty, **values):
+        """Assert that at least one matching error was created and return the matches"""
+        __tracebackhide__ = True
+        found = self.matching(expected_kls, expected_msg_regex, **values)
+        if not found:
+            created = "\n".join(f"    {error!r}" for error in self.errors[:20])
+            if len(self.errors) > 20:
+                created = f"{created}\n    ... and {len(self.errors) - 20} more"
+            assert False, f"No matching error was created\n  created:\n{created or '    nothing'}"
+        return found
+
+@pytest.fixture()
+def delfick_errors():
+    """Record every DelfickError created during the test"""
+    with ErrorCapture() as capture:
+        yield capture
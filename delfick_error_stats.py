@@ -0,0 +1,117 @@
+from delfick_error import structured_error
+
+from collections import Counter
+import random
+import json
+
+class ErrorStats:
+    """
+    Count errors by class and by fingerprint, keeping a few exemplars of each
+    fingerprint chosen by reservoir sampling.
+
+    Stats from different processes can be combined with ``merge`` and sent
+    between them with ``dumps`` and ``loads``.
+
+    .. code-block:: python
+
+        stats = ErrorStats(exemplars=3)
+        stats.add(error)
+        ...
+        total = ErrorStats.loads(payload_from_worker_one).merge(ErrorStats.loads(payload_from_worker_two))
+        for fingerprint, count in total.top(10):
+            ...
+    """
+    def __init__(self, exemplars=5, rand=None):
+        self.exemplars = exemplars
+        self.rand = rand or random.Random()
+
+        self.classes = Counter()
+        self.fingerprints = Counter()
+        self.fingerprint_classes = {}
+        self.samples = {}
+
+    def __len__(self):
+        return sum(self.classes.values())
+
+    def add(self, error):
+        """Count this error and maybe keep it as an exemplar"""
+        kls = error.__class__
+        name = f"{kls.__module__}.{kls.__qualname__}"
+        fingerprint = error.fingerprint()
+
+        self.classes[name] += 1
+        self.fingerprints[fingerprint] += 1
+        self.fingerprint_classes[fingerprint] = name
+
+        # Only describe the error if the reservoir wants it
+        count = self.fingerprints[fingerprint]
+        samples = self.samples.setdefault(fingerprint, [])
+        if len(samples) < self.exemplars:
+            samples.append(structured_error(error))
+        else:
+            index = self.rand.randrange(count)
+            if index < self.exemplars:
+                samples[index] = structured_error(error)
+
+    def merge(self, other):
+        """Add the stats from other into these stats and return these stats"""
+        for fingerprint, count in other.fingerprints.items():
+            mine = self.fingerprints[fingerprint]
+            self.samples[fingerprint] = self.merge_samples(
+                self.samples.get(fingerprint, []), mine, other.samples.get(fingerprint, []), count
+            )
+            self.fingerprint_classes[fingerprint] = other.fingerprint_classes[fingerprint]
+
+        self.classes.update(other.classes)
+        self.fingerprints.update(other.fingerprints)
+        return self
+
+    def merge_samples(self, samples, count, other_samples, other_count):
+        """Choose exemplars from two reservoirs, weighted by how many errors each saw"""
+        samples = list(samples)
+        other_samples = list(other_samples)
+        self.rand.shuffle(samples)
+        self.rand.shuffle(other_samples)
+
+        merged = []
+        while len(merged) < self.exemplars and (samples or other_samples):
+            if not other_samples or (samples and self.rand.random() * (count + other_count) < count):
+                merged.append(samples.pop())
+            else:
+                merged.append(other_samples.pop())
+        return merged
+
+    def top(self, amount=10, by="fingerprint"):
+        """Return the most common (fingerprint, count) or (class, count) pairs"""
+        if by == "class":
+            return self.classes.most_common(amount)
+        return self.fingerprints.most_common(amount)
+
+    def as_dict(self):
+        return {
+              "exemplars": self.exemplars
+            , "classes": dict(self.classes)
+            , "fingerprints": {
+                  fingerprint: [self.fingerprint_classes[fingerprint], count, self.samples.get(fingerprint, [])]
+                  for fingerprint, count in self.fingerprints.items()
+                }
+            }
+
+    @classmethod
+    def from_dict(kls, data, rand=None):
+        stats = kls(exemplars=data["exemplars"], rand=rand)
+        stats.classes.update(data["classes"])
+        for fingerprint, (name, count, samples) in data["fingerprints"].items():
+            stats.fingerprints[fingerprint] = count
+            stats.fingerprint_classes[fingerprint] = name
+            stats.samples[fingerprint] = samples
+        return stats
+
+    def dumps(self):
+        """Return these stats as compact json"""
+        return json.dumps(self.as_dict(), separators=(",", ":"), default=str)
+
+    @classmethod
+    def loads(kls, payload, rand=None):
+        """Make stats from the output of dumps"""
+        return kls.from_dict(json.loads(payload), rand=rand)
@@ -2,8 +2,8 @@ from setuptools import setup
 
 setup(
       name = "delfick_error"
-    , version = "1.8"
-    , py_modules = ['delfick_error', 'delfick_error_pytest']
+    , version = "1.9"
+    , py_modules = ['delfick_error', 'delfick_error_pytest', 'delfick_error_asyncio', 'delfick_error_logging', 'delfick_error_stats', 'delfick_error_metrics', 'delfick_error_archive']
 
     , install_requires =
       [ 'total-ordering'
@@ -2,12 +2,23 @@
 
 from __future__ import print_function
 
-from delfick_error import DelfickError, DelfickErrorTestMixin
+from delfick_error import (
+      DelfickError, DelfickErrorTestMixin, ErrorCollector, Lazy
+    , ambient_kwargs, detach_traceback, structured_error, kwargs_diff, errors_diff
+    , render_many, ProgrammerError, FrozenDelfickError, InvalidRecord, validate_stream
+    )
 
 from noseOfYeti.tokeniser.support import noy_sup_setUp
 from contextlib import contextmanager
 from unittest import TestCase
+import threading
+import logging
+import tempfile
+import shutil
 import random
+import json
+import time
+import os
 import nose
 import uuid
 import mock
@@ -19,6 +30,12 @@ class AError(DelfickError): pass
 class BError(DelfickError): pass
 class CError(DelfickError): pass
 
+class StackError(DelfickError):
+    stack_depth = 2
+
+class FrozenStackError(FrozenDelfickError):
+    stack_depth = 2
+
 describe TestCase, "DelfickError":
     it "creates a message that combines desc on the class, args and kwargs":
         error = DelfickError("The syncing was bad", a=4, b=5)
@@ -151,6 +168,89 @@ describe TestCase, "DelfickError":
 
             self.assertEqual(DelfickError().formatted_val(key, thing), "<|Failed to format val for exception: val={0}, error={1}|>".format(thing, error))
 
+    describe "format_budget":
+        it "gives up on slow delfick_error_format hooks and skips them for the rest of the render":
+            class Slow(object):
+                def delfick_error_format(self, key):
+                    time.sleep(0.5)
+                    return "slow"
+
+            class Fast(object):
+                def delfick_error_format(self, key):
+                    return "fast_{0}".format(key)
+
+            class Budgeted(DelfickError):
+                format_budget = 0.05
+
+            error = Budgeted(a=Slow(), b=Slow(), c=Fast())
+
+            start = time.time()
+            self.assertEqual(error.oneline(), "\t".join([
+                  "a=<|Timed out formatting val for exception: key=a, type=Slow, budget=0.05|>"
+                , "b=<|Skipped slow format for exception: key=b, type=Slow|>"
+                , "c=fast_c"
+                ]))
+            assert time.time() - start < 0.4
+
+            # And a new render tries the slow hooks again
+            self.assertEqual(error.as_dict()["a"], "<|Timed out formatting val for exception: key=a, type=Slow, budget=0.05|>")
+
+        it "doesn't let slow hooks stop fast hooks from being formatted":
+            release = threading.Event()
+
+            class Stuck(object):
+                def delfick_error_format(self, key):
+                    release.wait(5)
+                    return "stuck"
+
+            class Fast(object):
+                def delfick_error_format(self, key):
+                    return "fast"
+
+            class Budgeted(DelfickError):
+                format_budget = 0.05
+
+            try:
+                for _ in range(6):
+                    self.assertEqual(Budgeted(a=Stuck()).oneline(), "a=<|Timed out formatting val for exception: key=a, type=Stuck, budget=0.05|>")
+                self.assertEqual(Budgeted(a=Fast()).oneline(), "a=fast")
+            finally:
+                release.set()
+
+        it "doesn't make more than max_threads threads for stuck hooks":
+            from delfick_error import HookRunner
+
+            release = threading.Event()
+            runner = HookRunner(max_workers=1, max_threads=2)
+            try:
+                for _ in range(5):
+                    self.assertEqual(runner.run(0.01, release.wait, 5), (False, None))
+                self.assertEqual(runner.threads, 2)
+                self.assertEqual(runner.workers, 0)
+            finally:
+                release.set()
+
+            # One stuck thread goes back to work and the other stops
+            for _ in range(500):
+                if (runner.workers, runner.threads) == (1, 1):
+                    break
+                time.sleep(0.01)
+            self.assertEqual((runner.workers, runner.threads), (1, 1))
+            self.assertEqual(runner.run(5, lambda: 1), (True, 1))
+
+        it "still handles exceptions from hooks":
+            class Broken(object):
+                def delfick_error_format(self, key):
+                    raise ValueError("nope")
+
+                def __str__(self):
+                    return "broken"
+
+            class Budgeted(DelfickError):
+                format_budget = 1
+
+            self.assertEqual(str(Budgeted(a=Broken())), "a=<|Failed to format val for exception: val=broken, error=nope|>")
+
     describe "Sorting":
         def assertSorted(self, *errors):
             """Shuffle the provided errors and make sure they always get sorted into the provided order"""
@@ -200,6 +300,1245 @@ describe TestCase, "DelfickError":
                 AError("asdf", a=1, _errors=[5, 4]), AError("asdf", a=1, _errors=[6, 1]), BError("asdf", a=1, _errors=[1, 2]), BError("asdf", a=1, _errors=[1, 2, 1])
             )
 
+    describe "Lazy values":
+        it "doesn't call the func until the error is rendered":
+            func = mock.Mock(name="func", return_value="expensive")
+            error = DelfickError("blah", thing=Lazy(func))
+            self.assertEqual(len(func.mock_calls), 0)
+
+            self.assertEqual(str(error), '"blah"\tthing=expensive')
+            self.assertEqual(error.as_dict(), {"message": "blah", "thing": "expensive"})
+            self.assertEqual(error.oneline(), '"blah"\tthing=expensive')
+            func.assert_called_once_with()
+
+        it "formats the resolved value":
+            class WithFormat(object):
+                def delfick_error_format(self, key):
+                    return "formatted_{0}".format(key)
+
+            error = DelfickError(thing=Lazy(WithFormat))
+            self.assertEqual(str(error), "thing=formatted_thing")
+
+        it "compares and hashes on the resolved values":
+            self.assertEqual(DelfickError("a", one=Lazy(lambda: 1)), DelfickError("a", one=1))
+            self.assertNotEqual(DelfickError("a", one=Lazy(lambda: 2)), DelfickError("a", one=1))
+            self.assertEqual(hash(DelfickError("a", one=Lazy(lambda: 1))), hash(DelfickError("a", one=1)))
+            self.assertEqual(sorted([AError(one=Lazy(lambda: 2)), AError(one=1)]), [AError(one=1), AError(one=2)])
+
+        it "doesn't fail rendering if the func raises an exception":
+            def func():
+                raise ValueError("nope")
+            error = DelfickError(thing=Lazy(func))
+            self.assertEqual(str(error), "thing=<|Failed to resolve lazy val for exception: key=thing, error=nope|>")
+
+        it "only calls a func that raises an exception once":
+            func = mock.Mock(name="func", side_effect=ValueError("nope"))
+            lazy = Lazy(func)
+            error = DelfickError("blah", thing=lazy)
+
+            failed = '"blah"\tthing=<|Failed to resolve lazy val for exception: key=thing, error=nope|>'
+            self.assertEqual(str(error), failed)
+            self.assertEqual(error.oneline(), failed)
+            self.assertEqual(repr(lazy), "<Lazy failed ValueError('nope')>")
+            func.assert_called_once_with()
+
+            self.assertEqual(hash(error), hash(DelfickError("blah", thing=Lazy(mock.Mock(name="func2", side_effect=ValueError("nope"))))))
+            self.assertEqual(len(func.mock_calls), 1)
+
+        it "only calls the func once when rendered from many threads":
+            started = threading.Event()
+            release = threading.Event()
+            calls = []
+
+            def func():
+                calls.append(1)
+                started.set()
+                release.wait(5)
+                return "value"
+
+            error = DelfickError(thing=Lazy(func))
+            got = []
+            first = threading.Thread(target=lambda: got.append(str(error)))
+            first.start()
+            started.wait(5)
+
+            second = threading.Thread(target=lambda: got.append(str(error)))
+            second.start()
+            release.set()
+            first.join()
+            second.join()
+
+            self.assertEqual(got, ["thing=value", "thing=value"])
+            self.assertEqual(str(error), "thing=value")
+            self.assertEqual(len(calls), 1)
+
+        it "doesn't resolve the value for repr":
+            func = mock.Mock(name="func", return_value=1)
+            lazy = Lazy(func)
+            self.assertEqual(repr(lazy), "<Lazy unresolved>")
+            self.assertEqual(len(func.mock_calls), 0)
+            lazy.resolve()
+            self.assertEqual(repr(lazy), "<Lazy 1>")
+
+    describe "Message templates":
+        it "formats the message from the template and args":
+            error = DelfickError("Failed to get %s from %s", "thing", "place", one=1)
+            self.assertEqual(error.message, "Failed to get thing from place")
+            self.assertEqual(str(error), '"Failed to get thing from place"\tone=1')
+            self.assertEqual(error.as_dict(), {"message": "Failed to get thing from place", "one": 1})
+
+        it "supports a single dictionary of args":
+            error = DelfickError("Failed to get %(thing)s", {"thing": "stuff"})
+            self.assertEqual(error.message, "Failed to get stuff")
+
+        it "only formats the message once and only when asked":
+            arg = mock.Mock(name="arg")
+            arg.__str__ = mock.Mock(name="__str__", return_value="formatted")
+
+            error = DelfickError("blah %s", arg)
+            self.assertEqual(len(arg.__str__.mock_calls), 0)
+
+            self.assertEqual(error.message, "blah formatted")
+            self.assertEqual(error.oneline(), '"blah formatted"')
+            self.assertEqual(str(error), '"blah formatted"')
+            self.assertEqual(len(arg.__str__.mock_calls), 1)
+
+        it "compares and hashes without formatting the message":
+            class Thing(object):
+                def __str__(self):
+                    assert False, "Shouldn't be formatted"
+
+            thing = Thing()
+            self.assertEqual(DelfickError("blah %s", thing), DelfickError("blah %s", thing))
+            self.assertNotEqual(DelfickError("blah %s", thing), DelfickError("meh %s", thing))
+            self.assertNotEqual(DelfickError("blah %s", 1), DelfickError("blah %s", 2))
+            self.assertEqual(hash(DelfickError("blah %s", thing)), hash(DelfickError("blah %s", thing)))
+            self.assertEqual(hash(DelfickError("blah %s", [1])), hash(DelfickError("blah %s", [1])))
+
+        it "doesn't fail if the template can't be formatted":
+            error = DelfickError("blah %s %s", 1)
+            self.assertEqual(error.message, "<|Failed to format message for exception: template=blah %s %s, args=(1,), error=not enough arguments for format string|>")
+
+        it "resets the template when message is set":
+            error = DelfickError("blah %s", 1)
+            error.message = "other"
+            self.assertEqual(error.message, "other")
+            self.assertEqual(error.message_key(), ("other", ()))
+
+    describe "Enriching errors":
+        it "can make a copy of the error with more kwargs":
+            error = AError("blah %s", 1, one=1, two=2, _errors=[3])
+            error2 = error.with_kwargs(three=3, two=4)
+
+            self.assertIs(error2.__class__, AError)
+            self.assertEqual(error2.message, "blah 1")
+            self.assertEqual(dict(error2.kwargs), {"one": 1, "two": 4, "three": 3})
+            self.assertEqual(error2.errors, [3])
+            self.assertEqual(error2.oneline(), '"blah 1"\tone=1\tthree=3\ttwo=4')
+            self.assertEqual(error2, AError("blah %s", 1, one=1, two=4, three=3, _errors=[3]))
+
+            self.assertEqual(error.kwargs, {"one": 1, "two": 2})
+            self.assertEqual(error.oneline(), '"blah 1"\tone=1\ttwo=2')
+
+        it "doesn't copy kwargs when enriching more than once":
+            error = DelfickError(one=1)
+            error2 = error.with_kwargs(two=2).with_kwargs(three=3)
+            self.assertEqual(len(error2.kwargs.maps), 3)
+            self.assertIs(error2.kwargs.maps[-1], error.kwargs)
+            self.assertEqual(str(error2), "one=1\tthree=3\ttwo=2")
+
+        it "can make a copy of the error with more errors":
+            error = DelfickError("blah", one=1, _errors=[1, 2])
+            error2 = error.with_errors(3, 4).with_errors(5)
+            self.assertEqual(error2.errors, [1, 2, 3, 4, 5])
+            self.assertEqual(len(error2.errors), 5)
+            self.assertEqual(error2.errors[3], 4)
+            self.assertEqual(error2.errors[-1], 5)
+            self.assertEqual(error2.errors[1:3], [2, 3])
+            self.assertIs(error2.errors.parts[0], error.errors)
+            self.assertEqual(error2, DelfickError("blah", one=1, _errors=[5, 4, 3, 2, 1]))
+            self.assertEqual(error.errors, [1, 2])
+
+        it "can add errors with with_kwargs":
+            error = DelfickError(_errors=[1]).with_kwargs(one=1, _errors=[2])
+            self.assertEqual(error.errors, [1, 2])
+            self.assertEqual(dict(error.kwargs), {"one": 1})
+
+describe TestCase, "Ambient kwargs":
+    before_each:
+        # contextvars is only in python3.7+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 7:
+            raise nose.SkipTest()
+
+    it "adds ambient kwargs when rendering":
+        with ambient_kwargs(request_id="abc", stage=1):
+            error = DelfickError("blah", one=1, stage=2)
+
+        self.assertEqual(str(error), '"blah"\tone=1\trequest_id=abc\tstage=2')
+        self.assertEqual(error.as_dict(), {"message": "blah", "one": 1, "request_id": "abc", "stage": 2})
+        self.assertEqual(error.kwargs, {"one": 1, "stage": 2})
+
+    it "doesn't include ambient kwargs in comparisons":
+        with ambient_kwargs(request_id="abc"):
+            error = DelfickError("blah", one=1)
+        self.assertEqual(error, DelfickError("blah", one=1))
+        self.assertEqual(hash(error), hash(DelfickError("blah", one=1)))
+
+    it "layers nested ambient kwargs and resets on exit":
+        with ambient_kwargs(one=1, two=2):
+            with ambient_kwargs(two=3):
+                inner = DelfickError()
+            outer = DelfickError()
+        after = DelfickError()
+
+        self.assertEqual(str(inner), "one=1\ttwo=3")
+        self.assertEqual(str(outer), "one=1\ttwo=2")
+        self.assertEqual(str(after), "")
+
+    it "is isolated between contexts and threads":
+        import contextvars
+
+        got = {}
+        def make(name):
+            with ambient_kwargs(name=name):
+                got[name] = DelfickError()
+
+        with ambient_kwargs(outer=True):
+            contextvars.copy_context().run(make, "ctx")
+            thread = threading.Thread(target=make, args=("thread", ))
+            thread.start()
+            thread.join()
+            after = DelfickError()
+
+        self.assertEqual(str(got["ctx"]), "name=ctx\touter=True")
+        self.assertEqual(str(got["thread"]), "name=thread")
+        self.assertEqual(str(after), "outer=True")
+
+describe TestCase, "Fingerprint":
+    it "is the same for the same class, template and kwarg names":
+        self.assertEqual(AError("blah %s", 1, one=1).fingerprint(), AError("blah %s", 2, one=3).fingerprint())
+        self.assertEqual(len(AError().fingerprint()), 16)
+
+    it "is different for different class, template or kwarg names":
+        fingerprints = set([
+              AError("blah %s", 1, one=1).fingerprint()
+            , BError("blah %s", 1, one=1).fingerprint()
+            , AError("meh %s", 1, one=1).fingerprint()
+            , AError("blah %s", 1, two=1).fingerprint()
+            , AError("blah %s", 1).fingerprint()
+            ])
+        self.assertEqual(len(fingerprints), 5)
+
+    it "doesn't render the error":
+        class Thing(object):
+            def __str__(self):
+                assert False, "Shouldn't be formatted"
+        AError("blah %s", Thing(), thing=Thing()).fingerprint()
+
+describe TestCase, "Structured errors":
+    it "describes the parts of the error":
+        class Thing(object):
+            def delfick_error_format(self, key):
+                return "formatted_{0}".format(key)
+
+        class Described(DelfickError):
+            desc = "described"
+
+        error = Described("blah %s", 1, one=1, thing=Thing(), _errors=[AError("child"), ValueError("nope"), 3])
+        self.assertEqual(error.structured(), {
+              "class": "{0}.{1}".format(__name__, getattr(Described, "__qualname__", "Described"))
+            , "fingerprint": error.fingerprint()
+            , "desc": "described"
+            , "message": "blah 1"
+            , "kwargs": {"one": 1, "thing": "formatted_thing"}
+            , "errors": [
+                  {"class": "{0}.AError".format(__name__), "fingerprint": AError("child").fingerprint(), "message": "child", "kwargs": {}}
+                , {"class": "{0}.ValueError".format(ValueError.__module__), "message": "nope"}
+                , {"repr": "3"}
+                ]
+            })
+
+    it "works with structured_error":
+        error = AError(one=1)
+        self.assertEqual(structured_error(error), error.structured())
+
+describe TestCase, "ErrorStats":
+    before_each:
+        # delfick_error_stats is only python3.6+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 6:
+            raise nose.SkipTest()
+
+        from delfick_error_stats import ErrorStats
+        self.ErrorStats = ErrorStats
+
+    it "counts by class and fingerprint and keeps exemplars":
+        stats = self.ErrorStats(exemplars=2, rand=random.Random(1))
+        for i in range(10):
+            stats.add(AError("blah %s", i))
+        for i in range(3):
+            stats.add(AError("other", one=i))
+        stats.add(BError("blah %s", 1))
+
+        self.assertEqual(len(stats), 14)
+        self.assertEqual(stats.top(1, by="class"), [("{0}.AError".format(__name__), 13)])
+        self.assertEqual(stats.top(2), [(AError("blah %s", 1).fingerprint(), 10), (AError("other", one=1).fingerprint(), 3)])
+
+        samples = stats.samples[AError("blah %s", 1).fingerprint()]
+        self.assertEqual(len(samples), 2)
+        for sample in samples:
+            assert sample["message"].startswith("blah "), sample
+
+    it "only describes errors that are kept":
+        stats = self.ErrorStats(exemplars=1, rand=random.Random(1))
+        errors = [AError("blah") for _ in range(100)]
+        with mock.patch.object(AError, "structured", return_value={}) as structured:
+            for error in errors:
+                stats.add(error)
+        assert len(structured.mock_calls) < 20, len(structured.mock_calls)
+
+    it "can be merged and serialized":
+        one = self.ErrorStats(exemplars=2, rand=random.Random(1))
+        two = self.ErrorStats(exemplars=2, rand=random.Random(2))
+        for i in range(5):
+            one.add(AError("blah", one=i))
+            two.add(AError("blah", two=i))
+        two.add(AError("blah", one=20))
+        two.add(BError("meh"))
+
+        merged = self.ErrorStats.loads(one.dumps(), rand=random.Random(3)).merge(self.ErrorStats.loads(two.dumps()))
+        self.assertEqual(len(merged), 12)
+        self.assertEqual(dict(merged.top(by="class")), {"{0}.AError".format(__name__): 11, "{0}.BError".format(__name__): 1})
+
+        fingerprint = AError("blah", one=1).fingerprint()
+        self.assertEqual(merged.fingerprints[fingerprint], 6)
+        self.assertEqual(len(merged.samples[fingerprint]), 2)
+        self.assertEqual(merged.fingerprint_classes[fingerprint], "{0}.AError".format(__name__))
+
+        self.assertEqual(self.ErrorStats.loads(merged.dumps()).as_dict(), json.loads(merged.dumps()))
+
+describe TestCase, "Construction hooks":
+    it "calls hooks with each error that is created":
+        from delfick_error import add_construction_hook, remove_construction_hook
+
+        got = []
+        add_construction_hook(got.append)
+        try:
+            error = AError("blah", one=1)
+        finally:
+            remove_construction_hook(got.append)
+        BError()
+
+        self.assertEqual(len(got), 1)
+        self.assertIs(got[0], error)
+
+    it "doesn't let a failing hook replace the error":
+        from delfick_error import add_construction_hook, remove_construction_hook
+
+        def hook(error):
+            raise RuntimeError("hook broke")
+
+        add_construction_hook(hook)
+        try:
+            with mock.patch("delfick_error.log") as log:
+                try:
+                    raise AError("real")
+                except AError as error:
+                    self.assertEqual(error.message, "real")
+        finally:
+            remove_construction_hook(hook)
+
+        log.exception.assert_called_once_with("Construction hook failed: hook=%r", hook)
+
+describe TestCase, "ErrorMetrics":
+    before_each:
+        # delfick_error_metrics is only python3.6+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 6:
+            raise nose.SkipTest()
+
+        from delfick_error_metrics import ErrorMetrics
+        self.ErrorMetrics = ErrorMetrics
+
+    it "counts errors by class":
+        with self.ErrorMetrics() as metrics:
+            AError()
+            AError()
+            BError()
+        AError()
+
+        self.assertEqual(metrics.render(), "\n".join([
+              "# HELP delfick_errors_total Number of DelfickErrors created"
+            , "# TYPE delfick_errors_total counter"
+            , 'delfick_errors_total{error_class="AError"} 2'
+            , 'delfick_errors_total{error_class="BError"} 1'
+            , ""
+            ]))
+
+    it "counts errors by allowed kwargs and from many threads":
+        with self.ErrorMetrics(labels=["stage"], name="errors") as metrics:
+            def make():
+                for _ in range(100):
+                    AError(stage="one", other=1)
+            threads = [threading.Thread(target=make) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            AError(stage='a "quoted"\nvalue')
+            BError()
+
+        self.assertEqual(metrics.render().split("\n")[2:], [
+              'errors{error_class="AError",stage="a \\"quoted\\"\\nvalue"} 1'
+            , 'errors{error_class="AError",stage="one"} 400'
+            , 'errors{error_class="BError",stage=""} 1'
+            , ""
+            ])
+
+    it "doesn't resolve or format kwargs for labels":
+        func = mock.Mock(name="func", return_value="one")
+
+        class Thing(object):
+            def delfick_error_format(self, key):
+                assert False, "Shouldn't be formatted"
+
+            def __str__(self):
+                return "thing"
+
+        with self.ErrorMetrics(labels=["stage"]) as metrics:
+            AError(stage=Lazy(func))
+            AError(stage=Thing())
+
+        self.assertEqual(len(func.mock_calls), 0)
+        self.assertEqual(metrics.totals(), {("AError", ""): 1, ("AError", "thing"): 1})
+
+describe TestCase, "JsonFormatter":
+    before_each:
+        # delfick_error_logging is only python3
+        version_info = sys.version_info
+        if version_info[0] < 3:
+            raise nose.SkipTest()
+
+        from delfick_error_logging import JsonFormatter
+        self.formatter = JsonFormatter()
+
+    def record(self, msg, args=(), exc=None):
+        exc_info = None if exc is None else (type(exc), exc, None)
+        return logging.LogRecord("test", logging.ERROR, __file__, 1, msg, args, exc_info)
+
+    it "formats normal records":
+        data = json.loads(self.formatter.format(self.record("hello %s", ("there", ))))
+        self.assertEqual(data["msg"], "hello there")
+        self.assertEqual(data["level"], "ERROR")
+        self.assertEqual(data["logger"], "test")
+        assert "error" not in data
+
+    it "includes DelfickErrors as structured data without rendering them":
+        error = AError("blah", one=1, thing=object(), _errors=[BError(two=2)])
+        with mock.patch.object(AError, "__str__", side_effect=AssertionError("Shouldn't be rendered")):
+            data = json.loads(self.formatter.format(self.record(error)))
+
+        self.assertEqual(data["msg"], "blah")
+        self.assertEqual(data["error"]["kwargs"]["one"], 1)
+        self.assertEqual(data["error"]["kwargs"]["thing"], str(error.kwargs["thing"]))
+        self.assertEqual(data["error"]["errors"][0]["kwargs"], {"two": 2})
+
+    it "includes the error from exc_info and the suppressed count":
+        record = self.record("failed", exc=AError(one=1))
+        record.delfick_error_suppressed = 20
+        data = json.loads(self.formatter.format(record))
+        self.assertEqual(data["msg"], "failed")
+        self.assertEqual(data["error"]["kwargs"], {"one": 1})
+        self.assertEqual(data["suppressed"], 20)
+
+    it "includes the traceback and stack":
+        log = logging.getLogger("delfick_error_tests")
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        log.addHandler(handler)
+        try:
+            try:
+                raise AError("blah", one=1, _errors=[BError("child")])
+            except AError:
+                log.exception("failed", stack_info=True)
+        finally:
+            log.removeHandler(handler)
+
+        with mock.patch.object(AError, "__str__", side_effect=AssertionError("Shouldn't be rendered")):
+            with mock.patch.object(BError, "__str__", side_effect=AssertionError("Shouldn't be rendered")):
+                data = json.loads(self.formatter.format(records[0]))
+        self.assertEqual(data["error"]["kwargs"], {"one": 1})
+        assert data["exc_info"].startswith("Traceback (most recent call last):"), data["exc_info"]
+        assert 'raise AError("blah", one=1, _errors=[BError("child")])' in data["exc_info"]
+        self.assertEqual(data["error"]["errors"][0]["message"], "child")
+        assert data["stack_info"].startswith("Stack (most recent call last):"), data["stack_info"]
+
+    it "includes the whole exception when it isn't a DelfickError":
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            record = self.record("failed", exc=None)
+            record.exc_info = sys.exc_info()
+
+        data = json.loads(self.formatter.format(record))
+        assert "error" not in data
+        assert data["exc_info"].endswith("ValueError: nope"), data["exc_info"]
+
+describe TestCase, "DedupFilter":
+    before_each:
+        # delfick_error_logging is only python3
+        version_info = sys.version_info
+        if version_info[0] < 3:
+            raise nose.SkipTest()
+
+        from delfick_error_logging import DedupFilter
+        self.now = 0
+        self.filter = DedupFilter(interval=10, max_fingerprints=2, clock=lambda: self.now)
+
+    def record(self, msg, exc=None):
+        exc_info = None if exc is None else (type(exc), exc, None)
+        return logging.LogRecord("test", logging.ERROR, __file__, 1, msg, (), exc_info)
+
+    it "lets through records without a DelfickError":
+        for _ in range(3):
+            assert self.filter.filter(self.record("hello"))
+
+    it "lets through one record per fingerprint per interval":
+        class Thing(object):
+            def __str__(self):
+                assert False, "Shouldn't be formatted"
+
+        first = self.record(AError("blah %s", 1))
+        assert self.filter.filter(first)
+        self.assertEqual(first.delfick_error_suppressed, 0)
+        self.assertEqual(first.delfick_error_fingerprint, AError("blah %s", 1).fingerprint())
+
+        for i in range(5):
+            assert not self.filter.filter(self.record(AError("blah %s", Thing())))
+            assert not self.filter.filter(self.record("failed", AError("blah %s", Thing())))
+        assert self.filter.filter(self.record(BError("blah %s", 1)))
+
+        self.now = 10
+        after = self.record("failed", AError("blah %s", 3))
+        assert self.filter.filter(after)
+        self.assertEqual(after.delfick_error_suppressed, 10)
+        assert not self.filter.filter(self.record(AError("blah %s", 1)))
+
+    it "can flush the suppressed counts that haven't been reported":
+        fingerprint = AError("blah").fingerprint()
+        for i in range(4):
+            self.filter.filter(self.record(AError("blah")))
+        self.filter.filter(self.record(BError("blah")))
+
+        self.assertEqual(self.filter.flush(), {})
+        self.now = 10
+        self.assertEqual(self.filter.flush(), {fingerprint: 3})
+        self.assertEqual(self.filter.flush(), {})
+
+        self.now = 11
+        assert self.filter.filter(self.record(AError("blah")))
+        assert not self.filter.filter(self.record(AError("blah")))
+        self.assertEqual(self.filter.flush(), {})
+        self.assertEqual(self.filter.flush(force=True), {fingerprint: 1})
+
+        self.now = 30
+        record = self.record(AError("blah"))
+        assert self.filter.filter(record)
+        self.assertEqual(record.delfick_error_suppressed, 0)
+
+    it "forgets the oldest fingerprints":
+        assert self.filter.filter(self.record(AError()))
+        assert self.filter.filter(self.record(BError()))
+        assert self.filter.filter(self.record(CError()))
+        assert self.filter.filter(self.record(AError()))
+        assert not self.filter.filter(self.record(CError()))
+
+describe TestCase, "Splitting errors":
+    it "returns self if everything matches":
+        error = AError("blah", _errors=[BError("one"), BError("two")])
+        self.assertEqual(error.split(BError), (error, None))
+        self.assertIs(error.subgroup(BError), error)
+        self.assertIs(error.split(AError)[0], error)
+
+    it "returns None for match if nothing matches":
+        error = AError("blah", _errors=[BError("one")])
+        self.assertEqual(error.split(CError), (None, error))
+        self.assertIs(error.subgroup(CError), None)
+
+    it "splits nested errors and reuses what doesn't change":
+        b1 = BError("one")
+        c1 = CError("two")
+        inner_all_b = AError("inner", _errors=[BError("three")])
+        inner_mixed = AError("mixed", _errors=[BError("four"), CError("five")])
+        error = AError("blah", one=1, _errors=[b1, c1, inner_all_b, inner_mixed])
+
+        match, rest = error.split(BError)
+        self.assertEqual(match, AError("blah", one=1, _errors=[b1, inner_all_b, AError("mixed", _errors=[BError("four")])]))
+        self.assertIs(match.errors[0], b1)
+        self.assertIs(match.errors[1], inner_all_b)
+        self.assertEqual(rest, AError("blah", one=1, _errors=[c1, AError("mixed", _errors=[CError("five")])]))
+        self.assertEqual(error.errors, [b1, c1, inner_all_b, inner_mixed])
+
+    it "can split with a function":
+        error = AError("blah", _errors=[BError("one"), BError("two")])
+        self.assertEqual(error.subgroup(lambda e: e.message == "two"), AError("blah", _errors=[BError("two")]))
+
+describe TestCase, "ExceptionGroup":
+    before_each:
+        # ExceptionGroup is only in python3.11+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 11:
+            raise nose.SkipTest()
+
+    it "can convert to and from an ExceptionGroup":
+        e1 = BError("one")
+        e2 = ValueError("two")
+        error = AError("blah", one=1, _errors=[e1, e2])
+
+        group = error.as_exception_group()
+        self.assertEqual(group.message, "blah")
+        self.assertEqual(group.exceptions, (e1, e2))
+
+        back = CError.from_exception_group(group, two=2)
+        self.assertIs(back.errors, group.exceptions)
+        self.assertEqual(back.message, "blah")
+        self.assertEqual(back.kwargs, {"two": 2})
+        self.assertEqual(back.oneline(), '"blah"\ttwo=2')
+
+    it "complains if the errors can't go in an ExceptionGroup":
+        for errors, expected in ((
+              ([], "Can't make an ExceptionGroup without any errors")
+            , ([1, ValueError("two")], "Can't make an ExceptionGroup from errors that aren't exceptions: [1]")
+            )):
+            try:
+                AError("blah", _errors=errors).as_exception_group()
+                assert False, "Expected an error"
+            except ProgrammerError as error:
+                self.assertEqual(str(error), expected)
+
+    it "splits nested ExceptionGroups":
+        e1 = ValueError("one")
+        e2 = TypeError("two")
+        group = ExceptionGroup("group", [e1, e2])
+        error = AError("blah", _errors=[group])
+
+        match, rest = error.split(ValueError)
+        self.assertEqual(list(match.errors[0].exceptions), [e1])
+        self.assertEqual(list(rest.errors[0].exceptions), [e2])
+
+describe TestCase, "Stack summaries":
+    it "doesn't capture a stack by default":
+        error = DelfickError("blah")
+        self.assertIs(error.stack, None)
+        self.assertEqual(error.stack_summary(), [])
+        assert "stack" not in error.as_dict()
+
+    it "captures where the error was created and resolves it when rendered":
+        class WithStack(DelfickError):
+            stack_depth = 2
+
+            def __init__(self, *args, **kwargs):
+                self.extra = True
+                super(WithStack, self).__init__(*args, **kwargs)
+
+        def make_error():
+            return WithStack("blah", one=1)
+
+        error = make_error()
+        self.assertEqual(len(error.stack), 2)
+        code, lineno = error.stack[0]
+        self.assertEqual(code.co_name, "make_error")
+
+        summary = error.stack_summary()
+        self.assertEqual(summary[0], '{0}:{1} in make_error: return WithStack("blah", one=1)'.format(code.co_filename, lineno))
+        self.assertEqual(error.as_dict()["stack"], summary)
+        self.assertEqual(str(error), '"blah"\tone=1\n\tat {0}\n\tat {1}'.format(*summary))
+
+    it "only resolves each location once":
+        class WithStack(DelfickError):
+            stack_depth = 1
+
+        errors = [WithStack() for _ in range(3)]
+        with mock.patch("linecache.getline", return_value="line") as getline:
+            summaries = [error.stack_summary() for error in errors]
+
+        self.assertEqual(len(getline.mock_calls), 1)
+        self.assertEqual(summaries[0], summaries[2])
+
+    it "can be pickled with a stack":
+        import pickle
+
+        for kls in (StackError, FrozenStackError):
+            error = kls("blah", one=1)
+            restored = pickle.loads(pickle.dumps(error))
+            self.assertEqual(restored.stack_summary(), error.stack_summary())
+            self.assertEqual(str(restored), str(error))
+            self.assertEqual(restored, error)
+
+describe TestCase, "Matching":
+    it "returns None when kwargs match":
+        self.assertIs(kwargs_diff({"one": 1}, {"one": 1, "two": Lazy(lambda: 2)}), None)
+        self.assertIs(kwargs_diff({"two": 2}, {"one": 1, "two": Lazy(lambda: 2)}), None)
+
+    it "describes missing and mismatched kwargs up to a limit":
+        expected = dict(("k{0:02d}".format(i), i) for i in range(30))
+        actual = dict(("k{0:02d}".format(i), i + 1) for i in range(3))
+        diff = kwargs_diff(expected, actual, limit=2)
+
+        self.assertEqual(len(diff.missing), 27)
+        self.assertEqual(len(diff.mismatched), 3)
+        self.assertEqual(str(diff), "; ".join([
+              "Missing: 'k03', 'k04', ... and 25 more"
+            , "Mismatched: {'k00': expected=0, got=1}, {'k01': expected=1, got=2}, ... and 1 more"
+            ]))
+
+    it "matches errors in any order":
+        class Thing(object):
+            def __init__(self, val):
+                self.val = val
+
+            def delfick_error_format(self, key):
+                return "{0}:{1}".format(key, self.val)
+
+        expected = [AError("blah %s", i, thing=Thing(i), _errors=[1, 2]) for i in range(2000)] + [[1], [2]]
+        actual = [AError("blah %s", i, thing=Thing(i), _errors=[2, 1]) for i in reversed(range(2000))] + [[2], [1]]
+        self.assertIs(errors_diff(expected, actual), None)
+
+    it "matches errors that are equal but don't look the same":
+        self.assertIs(errors_diff([AError("x", thing=mock.ANY), mock.ANY], [2, AError("x", thing=5)]), None)
+        self.assertIs(errors_diff([AError("x", n=1)], [AError("x", n=1.0)]), None)
+
+        expected = [AError("x", n=mock.ANY), AError("x", n=5)]
+        self.assertIs(errors_diff(expected, [AError("x", n=5), AError("x", n=6)]), None)
+        self.assertIs(errors_diff(expected, [AError("x", n=6), AError("x", n=5)]), None)
+
+        with DelfickErrorCase().fuzzyAssertRaisesError(AError, _errors=[BError("x", thing=mock.ANY)]):
+            raise AError(_errors=[BError("x", thing=5)])
+
+        diff = errors_diff([AError("x", thing=mock.ANY), AError("x", thing=mock.ANY)], [AError("x", thing=5)])
+        self.assertEqual(len(diff.missing), 1)
+        self.assertEqual(diff.unexpected, [])
+
+    it "describes missing and unexpected errors":
+        diff = errors_diff([AError("one"), BError("two"), 1, 1, [3]], [BError("two"), 1, 2, [4], CError("three")])
+        self.assertEqual(diff.missing, [AError("one"), 1, [3]])
+        self.assertEqual(sorted(map(repr, diff.unexpected)), sorted(map(repr, [2, [4], CError("three")])))
+        self.assertEqual(str(diff), "Missing: 1, AError(one, , _errors=[]), [3]; Unexpected: 2, CError(three, , _errors=[]), [4]")
+
+describe TestCase, "render_many":
+    it "renders like rendering each error":
+        errors = [AError("one", a=1), BError("two %s", 2, _errors=[CError(c=3)]), ValueError("three")]
+        self.assertEqual(list(render_many(errors)), [errors[0].oneline(), errors[1].oneline(), "three"])
+        self.assertEqual(list(render_many(errors, mode="full")), [str(e) for e in errors])
+        self.assertEqual(list(render_many(errors, mode="dict")), [errors[0].as_dict(), errors[1].as_dict(), repr(errors[2])])
+
+    it "shares formatted values between errors":
+        class Config(object):
+            def __init__(self):
+                self.calls = 0
+
+            def delfick_error_format(self, key):
+                self.calls += 1
+                return "config_{0}".format(key)
+
+        config = Config()
+        errors = [AError("one", config=config, other=config), BError(config=config, _errors=[CError(config=config)])]
+        self.assertEqual(list(render_many(errors, mode="full")), [
+              '"one"\tconfig=config_config\tother=config_other'
+            , "config=config_config\nerrors:\n=======\n\n\tconfig=config_config\n-------"
+            ])
+        self.assertEqual(config.calls, 2)
+
+        str(errors[0])
+        self.assertEqual(config.calls, 4)
+
+    it "renders lazily":
+        made = []
+        def errors():
+            for i in range(3):
+                made.append(i)
+                yield AError(i=i)
+
+        rendered = render_many(errors())
+        self.assertEqual(next(rendered), "i=0")
+        self.assertEqual(made, [0])
+
+    it "complains about unknown modes":
+        try:
+            render_many([], mode="nope")
+            assert False, "Expected an error"
+        except ProgrammerError as error:
+            self.assertEqual(str(error), "Unknown render mode nope, choose from ['dict', 'full', 'oneline']")
+
+describe TestCase, "FrozenDelfickError":
+    it "can't be changed":
+        error = FrozenDelfickError("blah %s", 1, one=1, _errors=[1, 2])
+        self.assertEqual(str(error), "\"blah 1\"\tone=1\nerrors:\n=======\n\n\t1\n-------\n\t2\n-------")
+        self.assertEqual(error.errors, (1, 2))
+
+        for attr in ("message", "kwargs", "errors", "other"):
+            try:
+                setattr(error, attr, 2)
+                assert False, "Expected an error"
+            except AttributeError as e:
+                self.assertEqual(str(e), "Can't set {0} on a frozen error".format(attr))
+
+        try:
+            error.kwargs["two"] = 2
+            assert False, "Expected an error"
+        except TypeError:
+            pass
+
+    it "can still be raised and chained":
+        error = FrozenDelfickError("blah")
+        try:
+            six.raise_from(error, ValueError("cause"))
+        except FrozenDelfickError as e:
+            self.assertIs(e, error)
+
+    it "only works out hash, fingerprint and rendering once":
+        class Frozen(FrozenDelfickError):
+            pass
+
+        error = Frozen("blah", one=1)
+        with mock.patch.object(DelfickError, "as_tuple", wraps=error.as_tuple) as as_tuple:
+            self.assertEqual(hash(error), hash(error))
+        self.assertEqual(len(as_tuple.mock_calls), 1)
+
+        with mock.patch.object(DelfickError, "rendered_items", wraps=error.rendered_items) as rendered_items:
+            self.assertEqual(error.oneline(), '"blah"\tone=1')
+            self.assertEqual(str(error), '"blah"\tone=1')
+            self.assertEqual(str(error), '"blah"\tone=1')
+            self.assertEqual(error.oneline(), '"blah"\tone=1')
+        self.assertEqual(len(rendered_items.mock_calls), 1)
+
+        self.assertIs(error.fingerprint(), error.fingerprint())
+        self.assertEqual({error: 1}[Frozen("blah", one=1)], 1)
+
+    it "can be pickled":
+        import pickle
+
+        error = FrozenDelfickError("blah %s", 1, one=1, _errors=[AError("two")]).with_kwargs(three=3)
+        restored = pickle.loads(pickle.dumps(error))
+
+        self.assertEqual(restored, error)
+        self.assertEqual(hash(restored), hash(error))
+        self.assertEqual(str(restored), str(error))
+        self.assertEqual(dict(restored.kwargs), {"one": 1, "three": 3})
+        self.assertEqual(restored.errors, (AError("two"), ))
+
+        try:
+            restored.kwargs["four"] = 4
+            assert False, "Expected an error"
+        except TypeError:
+            pass
+
+        try:
+            restored.other = 4
+            assert False, "Expected an error"
+        except AttributeError as e:
+            self.assertEqual(str(e), "Can't set other on a frozen error")
+
+    it "doesn't remember renders that used a placeholder":
+        release = threading.Event()
+
+        class Thing(object):
+            def delfick_error_format(self, key):
+                release.wait(5)
+                return "thing"
+
+        class Frozen(FrozenDelfickError):
+            format_budget = 0.05
+
+        error = Frozen(thing=Thing())
+        try:
+            self.assertEqual(error.oneline(), "thing=<|Timed out formatting val for exception: key=thing, type=Thing, budget=0.05|>")
+        finally:
+            release.set()
+
+        self.assertEqual(error.oneline(), "thing=thing")
+        self.assertEqual(str(error), "thing=thing")
+        self.assertEqual(error.__dict__["_cache"], {"oneline": "thing=thing", "str": "thing=thing"})
+
+    it "stays frozen when enriched":
+        error = FrozenDelfickError("blah", one=1)
+        str(error)
+
+        error2 = error.with_kwargs(two=2).with_errors(3)
+        self.assertEqual(str(error2), "\"blah\"\tone=1\ttwo=2\nerrors:\n=======\n\n\t3\n-------")
+        self.assertEqual(str(error), '"blah"\tone=1')
+        try:
+            error2.kwargs["three"] = 3
+            assert False, "Expected an error"
+        except TypeError:
+            pass
+
+describe TestCase, "Error archive":
+    before_each:
+        # delfick_error_archive is only python3.6+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 6:
+            raise nose.SkipTest()
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "errors.archive")
+
+    after_each:
+        shutil.rmtree(self.directory)
+
+    it "can find archived errors by fingerprint, class and time":
+        from delfick_error_archive import ErrorArchiveWriter, ErrorArchiveReader
+
+        with ErrorArchiveWriter(self.path) as archive:
+            for i in range(5):
+                archive.append(AError("blah %s", i, one=i), created=100 + i)
+            archive.append(BError("other", _errors=[ValueError("nope")]), created=200)
+
+        with ErrorArchiveWriter(self.path) as archive:
+            archive.append(AError("blah %s", 20, one=20), created=300)
+            archive.append(ValueError("not delfick"), created=400)
+
+        with ErrorArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 8)
+
+            found = list(archive.by_fingerprint(AError("blah %s", 1, one=1).fingerprint()))
+            self.assertEqual([a.data["message"] for a in found], ["blah 0", "blah 1", "blah 2", "blah 3", "blah 4", "blah 20"])
+            self.assertEqual(found[1].data["kwargs"], {"one": 1})
+            self.assertEqual(found[1].created, 101)
+
+            self.assertEqual(list(archive.by_fingerprint("0000000000000000")), [])
+
+            found = list(archive.by_class("{0}.BError".format(__name__)))
+            self.assertEqual(len(found), 1)
+            self.assertEqual(found[0].data["errors"], [{"class": "builtins.ValueError", "message": "nope"}])
+
+            self.assertEqual([a.created for a in archive.between(102, 300)], [102, 103, 104, 200])
+            self.assertEqual([a.class_name for a in archive.between(start=300)], ["{0}.AError".format(__name__), "builtins.ValueError"])
+            self.assertEqual(len(list(archive)), 8)
+
+    it "removes a partial index entry left by a crash":
+        from delfick_error_archive import ErrorArchiveWriter, ErrorArchiveReader
+
+        with ErrorArchiveWriter(self.path) as archive:
+            archive.append(AError("one"), created=1)
+            archive.append(AError("two"), created=2)
+
+        with open(self.path, "ab") as f:
+            f.write(b'{"created":3')
+        with open("{0}.idx".format(self.path), "ab") as f:
+            f.write(b"partial")
+
+        with ErrorArchiveWriter(self.path) as archive:
+            archive.append(AError("three"), created=3)
+
+        with ErrorArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 3)
+            self.assertEqual([(a.created, a.data["message"]) for a in archive], [(1, "one"), (2, "two"), (3, "three")])
+
+    it "works with an empty archive":
+        from delfick_error_archive import ErrorArchiveWriter, ErrorArchiveReader
+
+        ErrorArchiveWriter(self.path).close()
+        with ErrorArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 0)
+            self.assertEqual(list(archive.by_class("thing")), [])
+
+    it "complains about files that aren't archives":
+        from delfick_error_archive import ErrorArchiveReader
+
+        with open(self.path, "w") as f:
+            f.write("nope")
+
+        try:
+            ErrorArchiveReader(self.path)
+            assert False, "Expected an error"
+        except ValueError as error:
+            self.assertEqual(str(error), "{0} is not an error archive".format(self.path))
+
+describe TestCase, "ErrorCollector":
+    it "collects errors into one error":
+        collector = ErrorCollector(AError, "things failed", stage=1)
+        assert not collector
+        collector.raise_errors()
+
+        e1 = BError("one")
+        e2 = CError("two")
+        collector.add(e1)
+        collector.add(e2)
+        self.assertEqual(len(collector), 2)
+
+        error = collector.error()
+        self.assertEqual(error, AError("things failed", stage=1, _errors=[e1, e2]))
+
+        try:
+            collector.raise_errors()
+            assert False, "Expected an error"
+        except AError as raised:
+            self.assertEqual(raised, error)
+
+    it "only keeps max_errors and counts the rest":
+        collector = ErrorCollector(AError, "things failed", max_errors=2, stage=1)
+        errors = [BError("error", i=i) for i in range(5)]
+        for error in errors:
+            collector.add(error)
+
+        assert collector
+        self.assertEqual(len(collector), 2)
+        self.assertEqual(collector.total, 5)
+        self.assertEqual(collector.dropped, 3)
+        self.assertEqual(collector.error(), AError("things failed", stage=1, dropped=3, _errors=errors[:2]))
+        self.assertEqual(collector.kwargs, {"stage": 1})
+
+    it "still raises when every error was dropped":
+        collector = ErrorCollector(AError, "things failed", max_errors=0)
+        collector.add(BError("one"))
+        self.assertEqual(len(collector), 0)
+
+        try:
+            collector.raise_errors()
+            assert False, "Expected an error"
+        except AError as raised:
+            self.assertEqual(raised, AError("things failed", dropped=1))
+
+describe TestCase, "validate_stream":
+    def positive(self, record):
+        if record < 0:
+            raise AError("Negative", value=record)
+
+    def even(self, record):
+        if record % 2:
+            raise ValueError("odd")
+
+    it "yields valid records and collects failures with their location":
+        collector = ErrorCollector(BError, "Bad records")
+        valid = list(validate_stream([2, -2, 3, -3, 4], [self.positive, self.even], collector))
+        self.assertEqual(valid, [2, 4])
+
+        self.assertEqual(len(collector), 4)
+        self.assertEqual(collector.errors[0], AError("Negative", value=-2, index=1))
+        self.assertEqual(collector.errors[1], InvalidRecord(index=2, _errors=[collector.errors[1].errors[0]]))
+        self.assertEqual(str(collector.errors[1].errors[0]), "odd")
+        self.assertEqual(collector.errors[2], AError("Negative", value=-3, index=3))
+        self.assertEqual(collector.errors[3].kwargs, {"index": 3})
+
+    it "only pulls records as they are needed":
+        pulled = []
+        def records():
+            for i in range(100):
+                pulled.append(i)
+                yield i
+
+        collector = ErrorCollector()
+        stream = validate_stream(records(), [self.even], collector)
+        self.assertEqual(next(stream), 0)
+        self.assertEqual(next(stream), 2)
+        self.assertEqual(pulled, [0, 1, 2])
+        self.assertEqual(len(collector), 1)
+
+    it "can stop after max_failures failed records and use a custom location":
+        collector = ErrorCollector(max_errors=1)
+        location = lambda index, record: {"line": index + 1}
+        stream = validate_stream(iter(range(-1, -1000, -1)), [self.positive, self.even], collector, max_failures=3, location=location)
+
+        self.assertEqual(list(stream), [])
+        self.assertEqual(collector.total, 5)
+        self.assertEqual(collector.errors, [AError("Negative", value=-1, line=1)])
+        self.assertEqual(collector.error().kwargs, {"dropped": 4})
+
+describe TestCase, "Detaching tracebacks":
+    def raised(self, error, cause=None):
+        try:
+            try:
+                raise cause or ValueError("cause")
+            except Exception as c:
+                if cause is not None:
+                    six.raise_from(error, c)
+                raise error
+        except Exception as e:
+            return e
+
+    it "replaces the traceback with a summary":
+        if not six.PY3:
+            raise nose.SkipTest()
+
+        cause = TypeError("cause")
+        error = self.raised(ValueError("blah"), cause=cause)
+        assert error.__traceback__ is not None
+        assert cause.__traceback__ is not None
+
+        detach_traceback(error)
+        self.assertIs(error.__traceback__, None)
+        self.assertIs(cause.__traceback__, None)
+        self.assertEqual(error.traceback_summary[0][2], "raised")
+        self.assertEqual(cause.traceback_summary[0][0], __file__)
+
+    it "removes the tracebacks of errors held by DelfickErrors and ExceptionGroups":
+        if not six.PY3:
+            raise nose.SkipTest()
+
+        grandchild = self.raised(ValueError("grandchild"))
+        child = self.raised(AError("child", _errors=[grandchild, 1]))
+        errors = [child]
+
+        if sys.version_info >= (3, 11):
+            in_group = self.raised(ValueError("in group"))
+            errors.append(self.raised(ExceptionGroup("group", [in_group])))
+
+        error = self.raised(BError("parent", _errors=errors))
+        detach_traceback(error)
+
+        for e in [error] + errors + [grandchild]:
+            self.assertIs(e.__traceback__, None)
+        if sys.version_info >= (3, 11):
+            self.assertIs(in_group.__traceback__, None)
+
+    it "is done when collecting errors if asked for":
+        if not six.PY3:
+            raise nose.SkipTest()
+
+        class Detaching(DelfickError):
+            detach_tracebacks = True
+
+        e1 = self.raised(ValueError("one"))
+        e2 = self.raised(ValueError("two"))
+        e3 = self.raised(ValueError("three"))
+
+        DelfickError(_errors=[e1])
+        assert e1.__traceback__ is not None
+
+        Detaching(_errors=[e1])
+        self.assertIs(e1.__traceback__, None)
+
+        ErrorCollector().add(e2)
+        assert e2.__traceback__ is not None
+
+        ErrorCollector(detach_tracebacks=True).add(e3)
+        self.assertIs(e3.__traceback__, None)
+        assert e3.traceback_summary
+
+describe TestCase, "gather_errors":
+    before_each:
+        # gather_errors is only python3.6+
+        version_info = sys.version_info
+        if version_info[0] < 3 or version_info[1] < 6:
+            raise nose.SkipTest()
+
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+
+    after_each:
+        self.loop.close()
+
+    def future(self, delay, result=None, error=None):
+        fut = self.loop.create_future()
+        if error is not None:
+            self.loop.call_later(delay, fut.set_exception, error)
+        else:
+            self.loop.call_later(delay, fut.set_result, result)
+        return fut
+
+    def gather(self, *args, **kwargs):
+        from delfick_error_asyncio import gather_errors
+        return self.loop.run_until_complete(gather_errors(*args, **kwargs))
+
+    it "returns results in order":
+        futs = [self.future(0.03, 1), self.future(0.01, 2), self.future(0.02, 3)]
+        self.assertEqual(self.gather(futs), [1, 2, 3])
+
+    it "raises one error with all the failures":
+        e1 = ValueError("one")
+        e2 = AError("two")
+        futs = [self.future(0.01, 1), self.future(0.02, error=e1), self.future(0.01, error=e2)]
+
+        try:
+            self.gather(futs, message="Failed to get things", error_kls=BError, stage=2)
+            assert False, "Expected an error"
+        except BError as error:
+            self.assertEqual(error.message, "Failed to get things")
+            self.assertEqual(error.kwargs, {"stage": 2})
+            self.assertEqual(list(error.errors), [e2, e1])
+
+    it "only runs limit awaitables at the same time":
+        running = []
+        most = []
+
+        def awaitables():
+            for i in range(10):
+                fut = self.future(0.001 * (i % 3), i)
+                running.append(fut)
+                fut.add_done_callback(running.remove)
+                most.append(len(running))
+                yield fut
+
+        self.assertEqual(self.gather(awaitables(), limit=3), list(range(10)))
+        self.assertEqual(max(most), 3)
+
+    it "complains if limit is less than 1":
+        for limit in (0, -1):
+            try:
+                self.gather([], limit=limit)
+                assert False, "Expected an error"
+            except ProgrammerError as error:
+                self.assertEqual(str(error), "limit must be at least 1, got {0}".format(limit))
+
+    it "cancels everything after max_failures":
+        taken = []
+        futs = [self.loop.create_future() for _ in range(2)]
+        slow = self.future(5, 1)
+
+        def fail():
+            for i, fut in enumerate(futs):
+                fut.set_exception(ValueError(i))
+        self.loop.call_later(0.01, fail)
+
+        def awaitables():
+            for fut in futs + [slow] + [self.future(0.01, i) for i in range(5)]:
+                taken.append(fut)
+                yield fut
+
+        try:
+            self.gather(awaitables(), limit=3, max_failures=2)
+            assert False, "Expected an error"
+        except DelfickError as error:
+            self.assertEqual(len(error.errors), 2)
+
+        assert slow.cancelled()
+        self.assertEqual(len(taken), 3)
+
+    it "counts dropped errors towards max_failures":
+        futs = [self.loop.create_future() for _ in range(2)]
+        slow = self.future(5, 1)
+
+        def fail():
+            for i, fut in enumerate(futs):
+                fut.set_exception(ValueError(i))
+        self.loop.call_later(0.01, fail)
+
+        try:
+            self.gather(futs + [slow], max_failures=2, max_errors=1)
+            assert False, "Expected an error"
+        except DelfickError as error:
+            self.assertEqual(len(error.errors), 1)
+            self.assertEqual(error.kwargs, {"dropped": 1})
+
+        assert slow.cancelled()
+
+    it "collects awaitables that were cancelled by something else":
+        import asyncio
+
+        cancelled = self.loop.create_future()
+        self.loop.call_later(0.01, cancelled.cancel)
+
+        try:
+            self.gather([self.future(0.01, 1), cancelled, self.future(0.02, 3)])
+            assert False, "Expected an error"
+        except DelfickError as error:
+            self.assertEqual(len(error.errors), 1)
+            assert isinstance(error.errors[0], asyncio.CancelledError)
+
 # Some objects for my expecting_raised_assertion helper
 class Called(object): pass
 class BeforeManager(object): pass
@@ -441,7 +1780,7 @@ describe TestCase, "Tests mixin":
                     if part is InsideManager:
                         iterator.send(Expected(one=1, two=2, _errors=[20, 5, 4, 3]))
                     elif part is AssertionRaised:
-                        assert "[3, 4, 5, 20] != [3, 4, 5, 10]" in str(val), str(val)
+                        self.assertEqual(str(val), "Errors are different: Missing: 10; Unexpected: 20")
 
                 self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
 
@@ -598,7 +1937,7 @@ describe TestCase, "standalone assert raises":
                 if part is InsideManager:
                     iterator.send(Expected("something", kwarg1="other"))
                 elif part is AssertionRaised:
-                    self.assertEqual(str(val), "Mismatched values")
+                    self.assertEqual(str(val), "Mismatched values (Mismatched: {'kwarg1': expected='meh', got='other'})")
 
             self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
 
@@ -610,7 +1949,7 @@ describe TestCase, "standalone assert raises":
                 if part is InsideManager:
                     iterator.send(Expected(one=1, two=2, three=3))
                 elif part is AssertionRaised:
-                    self.assertEqual(str(val), "Mismatched values")
+                    self.assertEqual(str(val), "Mismatched values (Mismatched: {'three': expected=1, got=3}, {'two': expected=1, got=2})")
 
             self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
 
@@ -622,7 +1961,7 @@ describe TestCase, "standalone assert raises":
                 if part is InsideManager:
                     iterator.send(Expected(one=1))
                 elif part is AssertionRaised:
-                    self.assertEqual(str(val), "Missing values")
+                    self.assertEqual(str(val), "Missing values (Missing: 'four', 'three')")
 
             self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
 
@@ -659,7 +1998,7 @@ describe TestCase, "standalone assert raises":
                 if part is InsideManager:
                     iterator.send(Expected(one=1, two=2, _errors=[20, 5, 4, 3]))
                 elif part is AssertionRaised:
-                    self.assertEqual(str(val), "Errors list is different")
+                    self.assertEqual(str(val), "Errors list is different (Missing: 10; Unexpected: 20)")
 
             self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
 
@@ -693,3 +2032,149 @@ describe TestCase, "standalone assert raises":
                     iterator.send(Expected(one=1, two=2, _errors=[e(10), e(5), e(4), e(3)]))
 
             self.assertEqual(called, [BeforeManager, InsideManager, NoAssertionRaised])
+
+    describe "Expectation":
+        it "can be reused":
+            from delfick_error_pytest import Expectation, assertRaises
+
+            class Expected(DelfickError): pass
+
+            expectation = Expectation(Expected, r"thing \d", one=1, _errors=[3, 1, 2])
+            self.assertEqual(expectation.errors, [3, 1, 2])
+
+            for i in range(3):
+                with assertRaises(expectation):
+                    raise Expected("thing {0}".format(i), one=1, two=i, _errors=[1, 3, 2])
+
+            assert expectation.matches(Expected("thing 1", one=1, _errors=[2, 3, 1]))
+            assert not expectation.matches(Expected("thing 1", one=2, _errors=[2, 3, 1]))
+            assert not expectation.matches(Expected("stuff", one=1, _errors=[2, 3, 1]))
+            assert not expectation.matches(ValueError("thing 1"))
+
+        it "complains like assertRaises":
+            from delfick_error_pytest import Expectation
+
+            class Expected(DelfickError): pass
+
+            called = []
+            for iterator, (part, val) in self.expecting_raised_assertion(called, Expectation(Expected, one=1)):
+                if part is InsideManager:
+                    iterator.send(Expected(one=2))
+                elif part is AssertionRaised:
+                    self.assertEqual(str(val), "Mismatched values (Mismatched: {'one': expected=1, got=2})")
+
+            self.assertEqual(called, [BeforeManager, InsideManager, AssertionRaised])
+
+        it "shares compiled regexes":
+            from delfick_error_pytest import RegexCompare
+            from delfick_error import compiled_regex
+
+            self.assertIs(RegexCompare(r"stuff \d+").r, compiled_regex(r"stuff \d+"))
+            compiled = compiled_regex("things")
+            self.assertIs(compiled_regex(compiled), compiled)
+
+        it "forgets the least recently used regexes":
+            from delfick_error import compiled_regex
+
+            from delfick_error import _compiled_regexes
+
+            with mock.patch.dict(_compiled_regexes, clear=True):
+                compiled_regex("one", max_size=2)
+                compiled_regex("two", max_size=2)
+                compiled_regex("one", max_size=2)
+                compiled_regex("three", max_size=2)
+                self.assertEqual(list(_compiled_regexes), ["one", "three"])
+
+        it "doesn't need to sort the expected errors":
+            from delfick_error_pytest import assertRaises
+
+            e = ValueError("b")
+            with assertRaises(AError, _errors=[e, BError("a")]):
+                raise AError(_errors=[BError("a"), e])
+
+    describe "ErrorCapture":
+        it "records errors created while active including ones that are swallowed":
+            from delfick_error_pytest import ErrorCapture, Expectation
+
+            class Expected(DelfickError): pass
+
+            with ErrorCapture() as capture:
+                try:
+                    raise Expected("swallowed", one=1)
+                except Expected:
+                    pass
+                other = AError("other %s", 2)
+            AError("after")
+
+            self.assertEqual(len(capture), 2)
+            self.assertEqual([e.message for e in capture], ["swallowed", "other 2"])
+            self.assertIs(capture.errors[0].__traceback__, None)
+            self.assertEqual(capture.matching(AError), [other])
+            self.assertEqual(capture.matching(Expectation(DelfickError, "other")), [other])
+            self.assertEqual(capture.assertCreated(Expected, "swal", one=1), [Expected("swallowed", one=1)])
+
+            try:
+                capture.assertCreated(Expected, one=2)
+                assert False, "Expected an assertion error"
+            except AssertionError as error:
+                self.assertEqual(str(error), "No matching error was created\n  created:\n    {0!r}\n    {1!r}".format(*capture.errors))
+
+        it "records the errors themselves and detaches tracebacks when finished":
+            from delfick_error_pytest import ErrorCapture
+
+            class Expected(DelfickError):
+                def __init__(self, *args, **kwargs):
+                    super().__init__(*args, **kwargs)
+                    self.extra = "extra"
+                    self.message = "changed"
+
+            try:
+                with ErrorCapture() as capture:
+                    try:
+                        raise Expected("original")
+                    except Expected:
+                        pass
+                    assert capture.errors[0].__traceback__ is not None
+                    raise AError("leaving")
+                assert False, "Expected an error"
+            except AError as error:
+                assert error.__traceback__ is not None
+                self.assertIs(capture.errors[1], error)
+
+            self.assertEqual(capture.errors[0].extra, "extra")
+            self.assertEqual(capture.assertCreated(Expected, "changed"), [capture.errors[0]])
+            self.assertIs(capture.errors[0].__traceback__, None)
+            assert capture.errors[0].traceback_summary
+
+        it "provides a delfick_errors fixture":
+            import delfick_error_pytest
+            import subprocess
+            import textwrap
+
+            directory = tempfile.mkdtemp()
+            try:
+                with open(os.path.join(directory, "test_fixture.py"), "w") as f:
+                    f.write(textwrap.dedent("""
+                        from delfick_error import DelfickError
+
+                        def test_records(delfick_errors):
+                            try:
+                                raise DelfickError("swallowed", one=1)
+                            except DelfickError:
+                                pass
+                            delfick_errors.assertCreated(DelfickError, "swal", one=1)
+
+                        def test_only_records_this_test(delfick_errors):
+                            assert len(delfick_errors) == 0
+                    """))
+
+                env = dict(os.environ, PYTEST_DISABLE_PLUGIN_AUTOLOAD="1", PYTHONPATH=os.path.dirname(os.path.abspath(delfick_error_pytest.__file__)))
+                process = subprocess.run(
+                      [sys.executable, "-m", "pytest", "-q", "-p", "delfick_error_pytest", "-p", "no:cacheprovider", directory]
+                    , cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                    )
+                output = process.stdout.decode()
+                self.assertEqual(process.returncode, 0, output)
+                assert "2 passed" in output, output
+            finally:
+                shutil.rmtree(directory)